@@ -0,0 +1,89 @@
+"""
+キーワード抽出のベンチマーク
+
+ローカルの抽出とGPTによる抽出について、1回あたりの処理時間と、
+whisperのpromptとしての質（トークン数、本文に含まれる語の割合、GPTとの一致率）を比較する
+
+    python -m benchmark.bench_keyword_extraction
+    python -m benchmark.bench_keyword_extraction --use_gpt  # GPTとも比較する（APIキーが必要）
+"""
+import argparse
+import statistics
+import time
+from typing import Callable, List
+
+from src.functions import extract_keywords
+from src.functions.utils import count_tokens
+
+SAMPLE_TEXTS = [
+    "人工知能は私たちの生活をより便利にし、効率的にするための強力なツールです。それは、データ分析、画像認識、自然言語処理など、多くの異なるタスクで使用することができます。",
+    "廃棄物発電、再生可能エネルギー（バイオマス、地熱、風力等）、コージェネレーション、石油・天然ガス開発といった各種施設・プラントのEPC・O&Mを通じて、持続可能な環境調和型社会の構築に貢献します。",
+    "えーと、それでは定例会議を始めます。まず配管工事の進捗ですが、A工区は予定通り来週から溶接に入ります。"
+    "B工区は資材の納期が遅れていて、ステンレス配管の入荷が2週間ほど遅れる見込みです。"
+    "工程表はTeamsで共有しますので、各自確認をお願いします。次に安全衛生ですが、先月ヒヤリハットが3件ありました。"
+    "いずれも足場での作業中のもので、KY活動の徹底をお願いします。最後に予算ですが、現時点で約300万円の超過となっています。",
+]
+
+
+def _measure(func: Callable[[], str], repeat: int) -> List[float]:
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed.append(time.perf_counter() - start)
+    return elapsed
+
+
+def _split(keywords: str) -> List[str]:
+    return [k.strip() for k in keywords.split(",") if k.strip()]
+
+
+def _coverage(keywords: List[str], text: str) -> float:
+    # 本文に含まれるキーワードの割合（whisperの認識に直接効く語かどうか）
+    if not keywords:
+        return 0.0
+    return sum([k in text for k in keywords]) / len(keywords)
+
+
+def _jaccard(a: List[str], b: List[str]) -> float:
+    if not a and not b:
+        return 1.0
+    return len(set(a) & set(b)) / len(set(a) | set(b))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="keyword extraction benchmark")
+    parser.add_argument("--repeat", type=int, default=100)
+    parser.add_argument("--num_of_keywords", type=int, default=5)
+    parser.add_argument("--use_gpt", action="store_true")
+    args = parser.parse_args()
+
+    for i, text in enumerate(SAMPLE_TEXTS):
+        print(f"===== sample {i + 1} ({len(text)} chars) =====")
+        local = extract_keywords(text, args.num_of_keywords, use_local=True)
+        local_elapsed = _measure(
+            lambda: extract_keywords(text, args.num_of_keywords, use_local=True),
+            args.repeat,
+        )
+        print(f"local : {local}")
+        print(
+            f"        latency={statistics.median(local_elapsed) * 1000:.3f}ms (median of {args.repeat})"
+            f", tokens={count_tokens(local)}"
+            f", coverage={_coverage(_split(local), text):.2f}"
+        )
+        if not args.use_gpt:
+            continue
+        start = time.perf_counter()
+        gpt = extract_keywords(text, args.num_of_keywords, use_local=False)
+        gpt_elapsed = time.perf_counter() - start
+        print(f"gpt   : {gpt}")
+        print(
+            f"        latency={gpt_elapsed * 1000:.3f}ms"
+            f", tokens={count_tokens(gpt)}"
+            f", coverage={_coverage(_split(gpt), text):.2f}"
+            f", jaccard(local, gpt)={_jaccard(_split(local), _split(gpt)):.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Taskの更新のベンチマーク
+
+各処理の最後に行うTaskの更新（deep copyとevolve）と、ワーカーでのログ出力用のdict化、
+次の処理へ渡すためのpickle化について、1回あたりの処理時間を比較する
+
+    python -m benchmark.bench_task_update
+    python -m benchmark.bench_task_update --num_of_transcriptions 5000
+"""
+import argparse
+import pickle
+import statistics
+import time
+from typing import Callable, List
+
+from src.functions.model import AudioData, Speaker, Transcription
+from src.model import Response, Task
+
+
+def _measure(func: Callable[[], object], repeat: int) -> List[float]:
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed.append(time.perf_counter() - start)
+    return elapsed
+
+
+def _make_task(num_of_sections: int, num_of_transcriptions: int) -> Task:
+    audio_data_list = [
+        AudioData(file_path=f"{i}.mp3", start=i * 600.0, end=(i + 1) * 600.0)
+        for i in range(num_of_sections)
+    ]
+    transcriptions = [
+        Transcription(
+            text="えーと、それでは定例会議を始めます。まず配管工事の進捗ですが、",
+            speaker=Speaker(name="A"),
+            features=[0.1] * 40,
+            start=i * 3.0,
+            end=i * 3.0 + 2.5,
+            section=i * num_of_sections // num_of_transcriptions,
+        )
+        for i in range(num_of_transcriptions)
+    ]
+    return Task(
+        id_="benchmark",
+        status="success",
+        progress="transcription completed",
+        audio_data_list=audio_data_list,
+        transcriptions=transcriptions,
+        response=Response(
+            responder="benchmark@example.com",
+            submit_date="2026/10/19 00:00:00",
+            description="定例会議",
+            add_title=True,
+            add_todo=True,
+        ),
+    )
+
+
+def _print(name: str, elapsed: List[float]):
+    print(f"{name:<28}: {statistics.median(elapsed) * 1000:9.3f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="task update benchmark")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--num_of_sections", type=int, default=6)
+    parser.add_argument("--num_of_transcriptions", type=int, default=1000)
+    args = parser.parse_args()
+
+    task = _make_task(args.num_of_sections, args.num_of_transcriptions)
+    update_ = dict(status="success", progress="summarization completed")
+    print(
+        f"===== {args.num_of_sections} sections, {args.num_of_transcriptions} transcriptions"
+        f" (median of {args.repeat}) ====="
+    )
+    _print(
+        "model_copy(deep=True)",
+        _measure(lambda: task.model_copy(deep=True, update=update_), args.repeat),
+    )
+    _print("evolve", _measure(lambda: task.evolve(**update_), args.repeat))
+    _print(
+        "model_dump() for logging",
+        _measure(
+            lambda: {k: v for k, v in task.model_dump().items() if k != "transcriptions"},
+            args.repeat,
+        ),
+    )
+    _print("to_log_dict", _measure(task.to_log_dict, args.repeat))
+    _print("pickle (to next stage)", _measure(lambda: pickle.dumps(task), args.repeat))
+    print(f"pickled size                : {len(pickle.dumps(task)) / 1024:9.1f}KiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,20 @@
 import argparse
+import math
+import contextlib
 import multiprocessing
+import multiprocessing.synchronize
 import os
+import queue
+import signal
+import threading
 import time
 import uuid
-from typing import Callable
+from typing import Callable, Dict, List, Tuple, Union
 
 from src import (
+    FairScheduler,
+    LeaseManager,
+    MemoryAdmission,
     clean_up,
     find_resnponse_file_path,
     media_to_audio_task,
@@ -15,6 +24,22 @@ from src import (
     summarization_task,
     transcription_task,
 )
+from src.config import (
+    AUTOSCALE_IDLE_SECONDS,
+    AUTOSCALE_INTERVAL_SECONDS,
+    AUTOSCALE_TARGET_WAIT_SECONDS,
+    LEASE_HEARTBEAT_SECONDS,
+    MAX_TASK_RESTARTS,
+    MEMORY_ADMISSION_RETRY_SECONDS,
+    NUM_RESULT_COLLECTORS,
+    QUEUE_MAXSIZE,
+    SCHEDULER_CAPACITY,
+    STAGE_TIMEOUT_SECONDS,
+    STAGE_WORKER_LIMITS,
+    USE_LEASE,
+    USE_MEMORY_ADMISSION,
+)
+from src.functions.config import OPENAI_API_WHISPER_DEPLOYMENTS
 from src.log.my_logger import MyLogger
 from src.model import Task
 from watchdog.events import FileSystemEventHandler
@@ -24,14 +49,41 @@ my_logger = MyLogger(__name__)
 logger = my_logger.logger
 
 
+def _track(
+    current_tasks: Union[Dict[int, Tuple[Union[float, None], Task]], None],
+    entry: Union[Tuple[Union[float, None], Task], None],
+    lock: Union[multiprocessing.synchronize.Lock, None] = None,
+):
+    # ワーカーが持っているタスクと処理の開始時刻を記録する（Noneで消す）
+    # lockはワーカーごとに作り、Supervisorが記録を確かめてからワーカーを止めるまでの間は更新させない
+    if current_tasks is None:
+        return
+    with lock if lock is not None else contextlib.nullcontext():
+        if entry is None:
+            current_tasks.pop(os.getpid(), None)
+        else:
+            current_tasks[os.getpid()] = entry
+
+
 def worker(
     func: Callable,
     task_queue: multiprocessing.Queue,
     result_queue: multiprocessing.Queue,
     final_result_queue: multiprocessing.Queue,
+    stats_queue: Union[multiprocessing.Queue, None] = None,
+    current_tasks: Union[Dict[int, Tuple[Union[float, None], Task]], None] = None,
+    lock: Union[multiprocessing.synchronize.Lock, None] = None,
 ):
+    # 停止はメインプロセスが"STOP"で指示するので、Ctrl+Cでは止まらないようにする
+    # （止まると、Supervisorが異常終了とみなして作り直してしまう）
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    admission = MemoryAdmission() if USE_MEMORY_ADMISSION else None
     for task in iter(task_queue.get, "STOP"):
-        d = {k: v for k, v in task.dict().items() if k != "transcriptions"}
+        # 受け取ったタスクは、メモリの空きを待っている間も含めて記録しておき、
+        # ワーカーが異常終了したときや制限時間を過ぎたときに、Supervisorがやり直すかエラーにする
+        # 開始時刻は処理を始めるまでNoneにして、待っている間は制限時間の対象にしない
+        _track(current_tasks, (None, task), lock)
+        d = task.to_log_dict()
         if task.status == "error":
             logger.info(
                 f"""
@@ -41,8 +93,25 @@ def worker(
                 task: {d}
                 """
             )
+            _track(current_tasks, None, lock)
             final_result_queue.put(task)
             continue
+        if admission is not None:
+            task, admitted = admission.admit(func.__name__, task)
+            if not admitted:
+                # メモリの空きが足りない場合はキューの後ろに戻して、先に小さいタスクを処理する
+                # キューが満杯で戻せない場合は、このワーカーで空きを待つ
+                time.sleep(MEMORY_ADMISSION_RETRY_SECONDS)
+                _track(current_tasks, None, lock)
+                try:
+                    task_queue.put_nowait(task)
+                    continue
+                except queue.Full:
+                    _track(current_tasks, (None, task), lock)
+                while not admitted:
+                    time.sleep(MEMORY_ADMISSION_RETRY_SECONDS)
+                    task, admitted = admission.admit(func.__name__, task)
+                    _track(current_tasks, (None, task), lock)
         logger.info(
             f"""
             start working!!
@@ -51,8 +120,20 @@ def worker(
             task: {d}
             """
         )
-        result: Task = func(task)
-        r = {k: v for k, v in result.dict().items() if k != "transcriptions"}
+        start = time.time()
+        _track(current_tasks, (start, task), lock)
+        try:
+            result: Task = func(task)
+        finally:
+            if admission is not None:
+                admission.release(func.__name__, task)
+        # 結果を渡す前に記録を消す
+        # （渡した後に止められたタスクをやり直すと、次の処理に同じタスクが2つ届くため）
+        _track(current_tasks, None, lock)
+        # 処理時間をSupervisorに知らせて、ワーカー数の調整に使う
+        if stats_queue is not None:
+            stats_queue.put((func.__name__, time.time() - start))
+        r = result.to_log_dict()
         if result.status == "success":
             logger.info(
                 f"""
@@ -75,20 +156,402 @@ def worker(
             final_result_queue.put(result)
 
 
+def collect_results(
+    result_queue: multiprocessing.Queue,
+    lease: Union[LeaseManager, None] = None,
+):
+    # 結果が届いたらすぐに保存と清掃処理を行う
+    # 複数のスレッドで動かして、同時に届いた結果を並列に処理する
+    for result in iter(result_queue.get, "STOP"):
+        logger.info(f"{result.id_} - result received")
+        try:
+            # 結果の保存
+            save_result(result)
+            # 保存できたら処理済みにして、ほかのマシンでは処理しないようにする
+            if lease is not None and result.media_file_path:
+                lease.complete(result.media_file_path)
+        except Exception as e:
+            logger.error(f"{result.id_} - failed to save result")
+            logger.error(f"{result.id_} - {e}")
+            # 保存できなかった場合は、leaseの期限切れを待ってやり直す
+            if lease is not None and result.media_file_path:
+                lease.release(result.media_file_path)
+        try:
+            # 清掃処理
+            clean_up(result)
+        except Exception as e:
+            logger.error(f"{result.id_} - failed to clean up")
+            logger.error(f"{result.id_} - {e}")
+
+
+class StagePool:
+    """
+    1つの処理（stage）のワーカープロセスをまとめて管理する
+    ワーカーを減らすときは、キューに"STOP"を入れて、どれか1つのワーカーに終了してもらう
+    """
+
+    def __init__(
+        self,
+        func: Callable,
+        task_queue: multiprocessing.Queue,
+        next_queue: multiprocessing.Queue,
+        final_result_queue: multiprocessing.Queue,
+        stats_queue: multiprocessing.Queue,
+        current_tasks: Dict[int, Tuple[Union[float, None], Task]],
+        min_workers: int,
+        max_workers: int,
+        scheduler: Union[FairScheduler, None] = None,
+    ):
+        self.func = func
+        self.task_queue = task_queue
+        self._next_queue = next_queue
+        self._final_result_queue = final_result_queue
+        self._stats_queue = stats_queue
+        self._current_tasks = current_tasks
+        self.min_workers = min_workers
+        self.max_workers = max(min_workers, max_workers)
+        self._processes: List[multiprocessing.Process] = []
+        # ワーカーごとの、current_tasksの記録を更新するときのlock（pid -> Lock）
+        self._locks: Dict[int, multiprocessing.synchronize.Lock] = {}
+        # "STOP"を送ったが、まだ終了していないワーカーの数
+        self._stopping = 0
+        # stopを呼んだ後は、終了したワーカーを作り直さない
+        self._closed = False
+        # キューに入れる前のタスクを預かり、順番を決める（feed_stage参照）
+        self.scheduler = scheduler
+        # 止めたワーカーや異常終了したワーカーは予約を解放できないので、代わりに解放する
+        self._admission = MemoryAdmission() if USE_MEMORY_ADMISSION else None
+
+    @property
+    def name(self) -> str:
+        return self.func.__name__
+
+    @property
+    def size(self) -> int:
+        return len(self._processes) - self._stopping
+
+    def _release(self, task: Task):
+        if self._admission is None:
+            return
+        try:
+            self._admission.release(self.name, task)
+        except Exception as e:
+            logger.warning(f"{task.id_} - failed to release memory reservation")
+            logger.warning(f"{task.id_} - {e}")
+
+    def _recover(self, task: Task):
+        if task.restart_count < MAX_TASK_RESTARTS:
+            logger.warning(f"{task.id_} - requeue task to {self.name}")
+            try:
+                self.task_queue.put(
+                    task.evolve(restart_count=task.restart_count + 1),
+                    timeout=AUTOSCALE_INTERVAL_SECONDS,
+                )
+                return
+            except queue.Full:
+                logger.error(f"{task.id_} - cannot requeue task. {self.name} queue is full")
+        logger.error(f"{task.id_} - give up task in {self.name}")
+        self._final_result_queue.put(
+            task.evolve(
+                status="error",
+                progress=f"worker died while running {self.name}",
+                message="処理中にワーカーが異常終了しました",
+            )
+        )
+
+    def enforce_deadline(self):
+        """
+        処理時間がSTAGE_TIMEOUT_SECONDSを超えたワーカーを止め、処理中のタスクはエラーにする
+        同じ入力でまた止まる可能性が高いので、やり直さない
+        止めたワーカーは、reapで作り直される
+        """
+        timeout = STAGE_TIMEOUT_SECONDS.get(self.name)
+        if timeout is None:
+            return
+        now = time.time()
+        for process in self._processes:
+            entry = self._current_tasks.get(process.pid)
+            # 開始時刻がNoneのタスクは、メモリの空きを待っていて、まだ処理を始めていない
+            if (
+                entry is None
+                or entry[0] is None
+                or now - entry[0] < timeout
+                or not process.is_alive()
+            ):
+                continue
+            # 記録を読んでから止めるまでの間に、ワーカーが処理を終えて次のタスクを受け取ることがあるので、
+            # ワーカーのlockを取って記録を読み直し、同じタスクを処理中のままの場合だけ止める
+            # （lockを持っている間は、ワーカーは記録を更新できず、結果を次の処理に渡せない）
+            lock = self._locks.get(process.pid)
+            if lock is None or not lock.acquire(timeout=1.0):
+                continue
+            try:
+                current = self._current_tasks.get(process.pid)
+                if (
+                    current is None
+                    or current[0] != entry[0]
+                    or current[1].id_ != entry[1].id_
+                ):
+                    continue
+                task = current[1]
+                logger.error(
+                    f"{task.id_} - {self.name} exceeded {timeout} seconds. kill worker (pid={process.pid})"
+                )
+                self._current_tasks.pop(process.pid, None)
+                process.kill()
+            finally:
+                lock.release()
+            self._release(task)
+            self._final_result_queue.put(
+                task.evolve(
+                    status="error",
+                    progress=f"{self.name} timed out",
+                    message="処理が制限時間内に終わりませんでした",
+                )
+            )
+
+    def reap(self):
+        """
+        終了したワーカーを片付ける
+        "STOP"以外で終了（異常終了）したワーカーは作り直し、処理中だったタスクはやり直すかエラーにする
+        """
+        alive: List[multiprocessing.Process] = []
+        num_dead = 0
+        for process in self._processes:
+            if process.is_alive():
+                alive.append(process)
+                continue
+            process.join()
+            self._locks.pop(process.pid, None)
+            if process.exitcode == 0 or self._closed:
+                self._stopping = max(0, self._stopping - 1)
+                continue
+            logger.error(
+                f"{self.name} - worker (pid={process.pid}) died with exitcode={process.exitcode}"
+            )
+            num_dead += 1
+            entry = self._current_tasks.pop(process.pid, None)
+            if entry is not None:
+                self._release(entry[1])
+                self._recover(entry[1])
+        self._processes = alive
+        if num_dead > 0:
+            logger.info(f"{self.name} - restart {num_dead} workers")
+            self.grow(num_dead)
+
+    def queued(self) -> Union[int, None]:
+        # macOSなど、qsizeが使えない環境ではNoneを返す
+        # 減らすために入れた"STOP"は数えない
+        try:
+            return max(0, self.task_queue.qsize() - self._stopping)
+        except NotImplementedError:
+            return None
+
+    def depth(self) -> Union[int, None]:
+        # schedulerが預かっているタスクも、待っているタスクとして数える
+        queued = self.queued()
+        if queued is None or self.scheduler is None:
+            return queued
+        return queued + len(self.scheduler)
+
+    def grow(self, n: int = 1):
+        for _ in range(n):
+            lock = multiprocessing.Lock()
+            process = multiprocessing.Process(
+                target=worker,
+                args=(
+                    self.func,
+                    self.task_queue,
+                    self._next_queue,
+                    self._final_result_queue,
+                    self._stats_queue,
+                    self._current_tasks,
+                    lock,
+                ),
+            )
+            process.start()
+            self._processes.append(process)
+            self._locks[process.pid] = lock
+
+    def shrink(self, n: int = 1) -> int:
+        """
+        キューに"STOP"を入れて、入れられた数を返す
+        キューが満杯で入れられない場合は、待ち続けずにやめる
+        """
+        for i in range(n):
+            try:
+                self.task_queue.put("STOP", timeout=AUTOSCALE_INTERVAL_SECONDS)
+            except queue.Full:
+                logger.warning(f"{self.name} - cannot send STOP. queue is full")
+                return i
+            self._stopping += 1
+        return n
+
+    def resize(self, n: int):
+        size = self.size
+        if n > size:
+            logger.info(f"{self.name} - scale up workers {size} -> {n}")
+            self.grow(n - size)
+        elif n < size:
+            logger.info(f"{self.name} - scale down workers {size} -> {n}")
+            self.shrink(size - n)
+
+    def stop(self):
+        """
+        すべてのワーカーに"STOP"を送る
+        キューが満杯で送れなかった場合は、待たずにワーカーを強制終了する
+        """
+        self._closed = True
+        size = self.size
+        if self.shrink(size) < size:
+            logger.warning(f"{self.name} - terminate workers")
+            for process in self._processes:
+                if process.is_alive():
+                    process.terminate()
+
+
+def feed_stage(
+    inbox: Union[multiprocessing.Queue, None],
+    pool: StagePool,
+    capacity: Union[int, None] = None,
+    lease: Union[LeaseManager, None] = None,
+):
+    """
+    inboxに届いたタスクをpoolのschedulerに預け、キューが空いたら次のタスクを選んで入れる
+    キューに入れたタスクは順番を変えられないので、キューにはほとんど溜めない
+    schedulerが預かるのはcapacityまでで、それ以上はinboxに溜めて前の処理を待たせる
+    inboxがない場合は、ほかのスレッド（Handler）がschedulerに直接預ける
+    leaseがある場合は、キューに入れる直前にleaseを取り、取れなかったタスクは捨てる
+    （schedulerで待っている間はleaseを持たないので、空いているほかのマシンが先に処理できる）
+    """
+    scheduler = pool.scheduler
+    if scheduler is None:
+        return
+    while True:
+        if inbox is not None and (capacity is None or len(scheduler) < capacity):
+            try:
+                scheduler.push(inbox.get(timeout=0.5))
+            except queue.Empty:
+                pass
+        else:
+            time.sleep(0.5)
+        while len(scheduler) > 0:
+            queued = pool.queued()
+            # qsizeが使えない環境では、届いた順にそのまま入れる
+            if queued is not None and queued > 0:
+                break
+            task = scheduler.pop()
+            if (
+                lease is not None
+                and task.media_file_path
+                and not lease.claim(task.media_file_path)
+            ):
+                logger.info(f"{task.id_} - {task.media_file_path} is processed by another node")
+                continue
+            pool.task_queue.put(task)
+
+
+class Supervisor:
+    """
+    処理ごとのキューの長さと処理時間を見て、ワーカー数を下限と上限の間で調整する
+
+    - キューの長さ x 平均処理時間 / ワーカー数 が目安の待ち時間を超える場合は、超えない数まで増やす
+    - キューが空のまま一定時間経った場合は、1つずつ減らしてメモリを返す
+    """
+
+    def __init__(self, pools: List[StagePool], stats_queue: multiprocessing.Queue):
+        self._pools = pools
+        self._stats_queue = stats_queue
+        # 処理ごとの平均処理時間（指数移動平均）
+        self._service_times: Dict[str, float] = {}
+        self._idle_since: Dict[str, float] = {}
+        self._stop_event = threading.Event()
+        self._thread: Union[threading.Thread, None] = None
+
+    def _drain_stats(self):
+        while True:
+            try:
+                name, elapsed = self._stats_queue.get_nowait()
+            except queue.Empty:
+                return
+            previous = self._service_times.get(name)
+            self._service_times[name] = (
+                elapsed if previous is None else 0.7 * previous + 0.3 * elapsed
+            )
+
+    def _desired_size(self, pool: StagePool) -> int:
+        size = pool.size
+        depth = pool.depth()
+        if depth is None:
+            return max(size, pool.min_workers)
+        now = time.time()
+        if depth > 0:
+            self._idle_since.pop(pool.name, None)
+            service_time = self._service_times.get(pool.name)
+            if service_time is None:
+                # 処理時間がまだわからない場合は、1つずつ増やす
+                desired = size + 1
+            else:
+                desired = max(
+                    size, math.ceil(depth * service_time / AUTOSCALE_TARGET_WAIT_SECONDS)
+                )
+        else:
+            idle_since = self._idle_since.setdefault(pool.name, now)
+            desired = size
+            if now - idle_since >= AUTOSCALE_IDLE_SECONDS:
+                desired = size - 1
+                self._idle_since[pool.name] = now
+        return min(max(desired, pool.min_workers), pool.max_workers)
+
+    def scale(self):
+        self._drain_stats()
+        for pool in self._pools:
+            pool.enforce_deadline()
+            pool.reap()
+            pool.resize(self._desired_size(pool))
+
+    def _run(self):
+        while not self._stop_event.wait(AUTOSCALE_INTERVAL_SECONDS):
+            try:
+                self.scale()
+            except Exception as e:
+                logger.warning("failed to scale workers")
+                logger.warning(e)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        # ワーカーを止める前にSupervisorを止めて、止めたワーカーを作り直さないようにする
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        for pool in self._pools:
+            pool.stop()
+
+
 class Watcher:
     def __init__(
         self,
         root_dir: str,
-        task_queue: multiprocessing.Queue,
+        scheduler: FairScheduler,
         result_queue: multiprocessing.Queue,
+        supervisor: Supervisor,
+        lease: Union[LeaseManager, None] = None,
     ):
         self._media_observer = Observer()
         self._root_dir = root_dir
-        self._task_queue = task_queue
+        self._scheduler = scheduler
+        self._lease = lease
         self._result_queue = result_queue
+        self._supervisor = supervisor
 
     def run(self):
-        media_event_handler = Handler(self._task_queue)
+        lease = self._lease
+        if lease is not None:
+            lease.start()
+        media_event_handler = Handler(self._scheduler)
         media_dir = os.path.join(self._root_dir, "media")
         self._media_observer.schedule(
             media_event_handler,
@@ -97,27 +560,38 @@ class Watcher:
         )
         self._media_observer.start()
         logger.info(f"Observer started at {media_dir}")
+        collectors = [
+            threading.Thread(
+                target=collect_results, args=(self._result_queue, lease), daemon=True
+            )
+            for _ in range(NUM_RESULT_COLLECTORS)
+        ]
+        for collector in collectors:
+            collector.start()
         try:
             while True:
-                time.sleep(5)
-                # 結果の収集などの追加のロジックは必要に応じてここに記述
-                # 今回は結果を表示するだけ
-                if self._result_queue.qsize() != 0:
-                    logger.info("result_queue created")
-                    result = self._result_queue.get()
-                    # 結果の保存
-                    save_result(result)
-                    # 清掃処理
-                    clean_up(result)
+                time.sleep(LEASE_HEARTBEAT_SECONDS)
+                # ほかのマシンが処理を止めたメディアを引き継ぐ
+                if lease is not None:
+                    for media_file_path in lease.find_expired():
+                        threading.Thread(
+                            target=media_event_handler.handle_media,
+                            args=(media_file_path,),
+                            daemon=True,
+                        ).start()
         except KeyboardInterrupt:
             logger.warning("keyboard interrupt detected")
             logger.warning("Observer Stopped")
             self._media_observer.stop()
             # すべてのプロセスを停止
-            for _ in range(args.num_workers):
-                self._task_queue.put("STOP")
+            self._supervisor.stop()
+            if lease is not None:
+                lease.stop()
+            for _ in range(NUM_RESULT_COLLECTORS):
                 self._result_queue.put("STOP")
-            self._task_queue.close()
+            # 保存中の結果は書き終わるまで待つ
+            for collector in collectors:
+                collector.join(timeout=60)
             self._result_queue.close()
         except Exception as e:
             logger.warning("unexpected error detected")
@@ -125,16 +599,27 @@ class Watcher:
             logger.warning("Observer Stopped")
             self._media_observer.stop()
             # すべてのプロセスを停止
-            for _ in range(args.num_workers):
-                self._task_queue.put("STOP")
+            self._supervisor.stop()
+            if lease is not None:
+                lease.stop()
+            for _ in range(NUM_RESULT_COLLECTORS):
                 self._result_queue.put("STOP")
-            self._task_queue.close()
+            # 保存中の結果は書き終わるまで待つ
+            for collector in collectors:
+                collector.join(timeout=60)
             self._result_queue.close()
 
 
 class Handler(FileSystemEventHandler):
-    def __init__(self, task_queue):
-        self.task_queue = task_queue
+    def __init__(self, scheduler: FairScheduler):
+        # タスクはmedia_to_audioのschedulerに預ける
+        # キューが満杯の間は、メディアをディスクに残したままscheduler上で順番を待つ（feed_stage参照）
+        # 複数のマシンで監視している場合は、キューに入れるときにleaseを取れたマシンだけが処理する
+        self.scheduler = scheduler
+
+    def _submit(self, task: Task):
+        self.scheduler.push(task)
+        logger.info(f"{task.id_} - submit {task.media_file_path} (waiting={len(self.scheduler)})")
 
     def on_created(self, event):
         # 動画ファイルが作成されたら，動画ファイルのパスをキューに追加
@@ -142,10 +627,16 @@ class Handler(FileSystemEventHandler):
         # なので，ファイルのvalidation等はここでは行わない
         if event.is_directory:
             return
+        self.handle_media(event.src_path)
+
+    def handle_media(self, src_path: str):
+        # 期限切れのleaseを見つけるたびに呼ばれるので、すでに預けているメディアは預けない
+        if self.scheduler.has_media(src_path):
+            return
 
         # 動画ファイルに対応するレスポンスファイルのパスを取得
-        root_dir = os.path.dirname(os.path.dirname(event.src_path))
-        media_file_name = os.path.basename(event.src_path)
+        root_dir = os.path.dirname(os.path.dirname(src_path))
+        media_file_name = os.path.basename(src_path)
 
         # 動画ファイルとresponseファイルにアクセスができるようになるまで待機
         # 15分経ってもアクセスできない場合は，エラーとして処理を中断
@@ -159,7 +650,7 @@ class Handler(FileSystemEventHandler):
                 if not response_file_path:
                     raise Exception()
                 response = read_response_file(response_file_path)
-                with open(event.src_path, "rb"):
+                with open(src_path, "rb"):
                     break
             except Exception as e:
                 if time.time() - current_time <= 15 * 60:
@@ -167,32 +658,32 @@ class Handler(FileSystemEventHandler):
                     continue
                 logger.error(
                     f"""
-                    cannot access to {event.src_path} for 15 minutes.
+                    cannot access to {src_path} for 15 minutes.
                     please check the file.
                     """
                 )
-                self.task_queue.put(
+                self._submit(
                     Task(
                         id_=str(uuid.uuid4()),
                         status="error",
                         progress="cannot access to response file or media file",
                         response_file_path=response_file_path,
-                        media_file_path=event.src_path,
-                        media_file_name=os.path.basename(event.src_path),
+                        media_file_path=src_path,
+                        media_file_name=os.path.basename(src_path),
                         response=None,
                         message="回答ファイルまたは動画ファイルへのアクセスに失敗しました",
                     )
                 )
                 return
 
-        self.task_queue.put(
+        self._submit(
             Task(
                 id_=str(uuid.uuid4()),
                 status="success",
                 progress="start media_to_audio",
                 response_file_path=response_file_path,
-                media_file_path=event.src_path,
-                media_file_name=os.path.basename(event.src_path),
+                media_file_path=src_path,
+                media_file_name=os.path.basename(src_path),
                 response=response,
             )
         )
@@ -212,6 +703,8 @@ if __name__ == "__main__":
         help="num of workers for multiprocessing",
     )
     args = parser.parse_args()
+    # 複数のマシンで監視している場合に、メディアファイルごとに処理するマシンを決める
+    lease = LeaseManager(args.root_dir) if USE_LEASE else None
     logger.info(
         f"""
         ================================
@@ -221,65 +714,84 @@ if __name__ == "__main__":
         ================================
         """
     )
-    media_to_audio_queue: multiprocessing.Queue = multiprocessing.Queue()
-    audio_split_queue: multiprocessing.Queue = multiprocessing.Queue()
-    transcription_queue: multiprocessing.Queue = multiprocessing.Queue()
-    summarization_queue: multiprocessing.Queue = multiprocessing.Queue()
-    result_queue: multiprocessing.Queue = multiprocessing.Queue()
-
-    # media to audio
-    for _ in range(args.num_workers):
-        worker_ = multiprocessing.Process(
-            target=worker,
-            args=(
-                media_to_audio_task,
-                media_to_audio_queue,
-                audio_split_queue,
-                result_queue,
-            ),
-        )
-        worker_.start()
-
-    # split_audio
-    for _ in range(args.num_workers):
-        worker_ = multiprocessing.Process(
-            target=worker,
-            args=(
-                split_audio_task,
-                audio_split_queue,
-                transcription_queue,
-                result_queue,
-            ),
-        )
-        worker_.start()
+    # キューの大きさを制限して、後ろの処理が追いつかないときは前の処理を待たせる
+    media_to_audio_queue: multiprocessing.Queue = multiprocessing.Queue(
+        QUEUE_MAXSIZE["media_to_audio"]
+    )
+    audio_split_queue: multiprocessing.Queue = multiprocessing.Queue(
+        QUEUE_MAXSIZE["audio_split"]
+    )
+    transcription_queue: multiprocessing.Queue = multiprocessing.Queue(
+        QUEUE_MAXSIZE["transcription"]
+    )
+    summarization_queue: multiprocessing.Queue = multiprocessing.Queue(
+        QUEUE_MAXSIZE["summarization"]
+    )
+    # 処理に時間がかかるmedia_to_audioとtranscriptionは、
+    # FairSchedulerで順番を決めてからキューに入れる
+    # media_to_audioはHandlerがschedulerに直接預け、transcriptionは一度inboxで受け取る
+    transcription_inbox: multiprocessing.Queue = multiprocessing.Queue(
+        QUEUE_MAXSIZE["transcription"]
+    )
+    inboxes = {
+        media_to_audio_task.__name__: None,
+        transcription_task.__name__: transcription_inbox,
+    }
+    result_queue: multiprocessing.Queue = multiprocessing.Queue(QUEUE_MAXSIZE["result"])
+    stats_queue: multiprocessing.Queue = multiprocessing.Queue()
+    # ワーカーごとの受け取ったタスク（pid -> (処理の開始時刻, Task)）
+    manager = multiprocessing.Manager()
+    current_tasks = manager.dict()
 
+    # 処理ごとのワーカー数は、Supervisorがキューの長さと処理時間を見て調整する
     # transcription
-    # whisperの制限により，同時に3つまでしか処理できない
-    for _ in range(3):  # args.num_workers
-        worker_ = multiprocessing.Process(
-            target=worker,
-            args=(
-                transcription_task,
-                transcription_queue,
-                summarization_queue,
-                result_queue,
-            ),
-        )
-        worker_.start()
-
-    # summarization
-    for _ in range(args.num_workers):
-        worker_ = multiprocessing.Process(
-            target=worker,
-            args=(
-                summarization_task,
-                summarization_queue,
-                result_queue,
-                result_queue,
-            ),
+    # whisperの制限により，deploymentごとに同時に処理できる数が決まっている
+    # deploymentを追加すると，その分だけ並列に処理できる
+    num_transcription_workers = sum(
+        [d["max_concurrency"] for d in OPENAI_API_WHISPER_DEPLOYMENTS]
+    )
+    stages = [
+        (media_to_audio_task, media_to_audio_queue, audio_split_queue),
+        (split_audio_task, audio_split_queue, transcription_inbox),
+        (transcription_task, transcription_queue, summarization_queue),
+        (summarization_task, summarization_queue, result_queue),
+    ]
+    pools: List[StagePool] = []
+    for func, task_queue, next_queue in stages:
+        limits = STAGE_WORKER_LIMITS[func.__name__]
+        pool = StagePool(
+            func=func,
+            task_queue=task_queue,
+            next_queue=next_queue,
+            final_result_queue=result_queue,
+            stats_queue=stats_queue,
+            current_tasks=current_tasks,
+            min_workers=limits["min_workers"],
+            max_workers=limits["max_workers"] or num_transcription_workers,
+            scheduler=FairScheduler() if func.__name__ in inboxes else None,
         )
-        worker_.start()
+        # 起動時は--num_workersの数（上限と下限の範囲内）から始める
+        pool.grow(min(max(args.num_workers, pool.min_workers), pool.max_workers))
+        pools.append(pool)
+        if pool.scheduler is not None:
+            threading.Thread(
+                target=feed_stage,
+                args=(
+                    inboxes[func.__name__],
+                    pool,
+                    SCHEDULER_CAPACITY.get(func.__name__),
+                    lease if func.__name__ == media_to_audio_task.__name__ else None,
+                ),
+                daemon=True,
+            ).start()
+    supervisor = Supervisor(pools, stats_queue)
+    supervisor.start()
 
     logger.info(f"start watching {args.root_dir}")
-    watcher = Watcher(args.root_dir, media_to_audio_queue, result_queue)
+    media_to_audio_scheduler = next(
+        p.scheduler for p in pools if p.name == media_to_audio_task.__name__
+    )
+    watcher = Watcher(
+        args.root_dir, media_to_audio_scheduler, result_queue, supervisor, lease
+    )
     watcher.run()
@@ -0,0 +1,69 @@
+"""
+既知の話者を登録する
+
+音声ファイルの中で、その話者だけが話している区間（秒）を指定して、SpeakerIndexに特徴量を登録する
+登録した話者は、文字起こしの話者識別（USE_SPEAKER_RECOGNITION）で引けるようになる
+同じ話者を別の音声ファイルで登録し直すと、特徴量が追加される
+
+    python register_speaker.py --name 山田太郎 --audio_file_path yamada.mp3 --start_and_ends 0-30 45.5-60
+    python register_speaker.py --name 山田太郎 --email yamada@example.com --audio_file_path yamada.mp3 --start_and_ends 0-30
+"""
+import argparse
+import sys
+from typing import List
+
+from src.functions import register_speaker
+from src.functions.model import Speaker
+from src.functions.utils import SpeakerIndex
+from src.log.my_logger import MyLogger
+
+my_logger = MyLogger(__name__)
+logger = my_logger.logger
+
+
+def parse_start_and_ends(values: List[str]) -> List[List[float]]:
+    # "start-end"（秒）の形式で受け取る
+    start_and_ends = []
+    for value in values:
+        start, end = value.split("-")
+        start_and_ends.append([float(start), float(end)])
+    return start_and_ends
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="register a known speaker")
+    parser.add_argument("--name", type=str, required=True, help="speaker name")
+    parser.add_argument("--id", type=str, default="", help="speaker id")
+    parser.add_argument("--email", type=str, default="", help="speaker email")
+    parser.add_argument(
+        "--audio_file_path",
+        type=str,
+        required=True,
+        help="audio file in which the speaker talks",
+    )
+    parser.add_argument(
+        "--start_and_ends",
+        type=str,
+        nargs="+",
+        required=True,
+        help="sections (seconds) in which only the speaker talks, e.g. 0-30 45.5-60",
+    )
+    parser.add_argument(
+        "--index_dir",
+        type=str,
+        default=None,
+        help="directory of the speaker index (default: SPEAKER_INDEX_DIR)",
+    )
+    args = parser.parse_args()
+    speaker = Speaker(id=args.id, email=args.email, name=args.name)
+    speaker_index = SpeakerIndex(index_dir=args.index_dir)
+    registered = register_speaker(
+        speaker,
+        args.audio_file_path,
+        parse_start_and_ends(args.start_and_ends),
+        speaker_index=speaker_index,
+    )
+    if not registered:
+        logger.error(f"failed to extract features of {args.name} from {args.audio_file_path}")
+        sys.exit(1)
+    logger.info(f"registered {args.name} (speakers in index: {len(speaker_index)})")
@@ -1,5 +1,14 @@
+from .admission import MemoryAdmission
+from .lease import LeaseManager
 from .media_to_audio import media_to_audio_task
+from .scheduler import FairScheduler
 from .split_audio import split_audio_task
 from .summarization import summarization_task
 from .transcription import transcription_task
-from .utils import clean_up, find_resnponse_file_path, read_response_file, save_result
+from .utils import (
+    clean_up,
+    find_resnponse_file_path,
+    parse_speakers,
+    read_response_file,
+    save_result,
+)
@@ -0,0 +1,158 @@
+import json
+import os
+import time
+from typing import Dict, Tuple, Union
+
+from filelock import FileLock
+from src.config import (
+    MEMORY_BASE_BYTES,
+    MEMORY_BUDGET_BYTES,
+    MEMORY_FACTORS,
+    MEMORY_LEDGER_DIR,
+    MEMORY_RESERVATION_SECONDS,
+    MEMORY_STARVATION_SECONDS,
+    MEMORY_WAITING_SECONDS,
+)
+from src.functions import MediaToAudioConverter
+from src.functions.model import MediaProbe
+from src.log.my_logger import MyLogger
+from src.model import Task
+
+my_logger = MyLogger(__name__)
+logger = my_logger.logger
+
+
+class MemoryAdmission:
+    """
+    メディアの長さからメモリ使用量を見積もり、空きがある場合だけ処理を始めさせる
+    予約はファイルに記録するので、すべてのワーカープロセスで共有される
+    予約が1つもない場合は、予算を超える大きいタスクでも処理を始めさせる（いつまでも待たないように）
+    空きを待っているタスクも記録し、MEMORY_STARVATION_SECONDSより長く待っているタスクがある場合は、
+    最も長く待っているタスクの分の空きを残せるときだけ、ほかのタスクを始めさせる
+    """
+
+    def __init__(
+        self,
+        budget_bytes: Union[int, None] = None,
+        ledger_dir: Union[str, None] = None,
+    ):
+        self._budget_bytes = budget_bytes or MEMORY_BUDGET_BYTES
+        ledger_dir = ledger_dir or MEMORY_LEDGER_DIR
+        os.makedirs(ledger_dir, exist_ok=True)
+        self._ledger_file_path = os.path.join(ledger_dir, "ledger.json")
+        self._lock = FileLock(self._ledger_file_path + ".lock")
+
+    @staticmethod
+    def _key(stage: str, task: Task) -> str:
+        return f"{task.id_}|{stage}"
+
+    def _read(self) -> Dict[str, Dict[str, Dict]]:
+        """
+        予約（reservations）と、空きを待っているタスク（waiting）を読み込む
+        """
+        try:
+            with open(self._ledger_file_path, "r", encoding="UTF-8") as f:
+                ledger = json.load(f)
+        except Exception:
+            ledger = {}
+        # 期限切れの記録（解放されなかった分）は無視する
+        now = time.time()
+        return {
+            name: {
+                k: v for k, v in ledger.get(name, {}).items() if v["expires_at"] > now
+            }
+            for name in ["reservations", "waiting"]
+        }
+
+    def _write(self, ledger: Dict[str, Dict[str, Dict]]):
+        with open(self._ledger_file_path, "w", encoding="UTF-8") as f:
+            json.dump(ledger, f)
+
+    @staticmethod
+    def estimate(stage: str, probe: MediaProbe) -> int:
+        """
+        処理に必要なメモリ量（byte）を見積もる
+        """
+        pcm_bytes = probe.duration * probe.sample_rate * probe.channels * 2
+        return int(MEMORY_BASE_BYTES + pcm_bytes * MEMORY_FACTORS.get(stage, 0.0))
+
+    @staticmethod
+    def _probe(stage: str, task: Task) -> Union[MediaProbe, None]:
+        # 一度調べた結果はtaskに持たせて、次の処理やキューに戻したときに使い回す
+        if task.media_probe is not None:
+            return task.media_probe
+        if stage == "media_to_audio_task":
+            file_path = task.media_file_path
+        else:
+            file_path = task.audio_file_path
+        if not file_path or not os.path.exists(file_path):
+            return None
+        try:
+            return MediaToAudioConverter.probe(file_path)
+        except Exception as e:
+            logger.warning(f"{task.id_} - failed to probe {file_path}")
+            logger.warning(f"{task.id_} - {e}")
+            return None
+
+    def admit(self, stage: str, task: Task) -> Tuple[Task, bool]:
+        """
+        メモリを予約できた場合はTrueを返す
+        見積もりの対象外の処理や、調べられないファイル（処理の中でエラーにする）はそのまま通す
+        """
+        if stage not in MEMORY_FACTORS:
+            return task, True
+        probe = self._probe(stage, task)
+        if probe is None:
+            return task, True
+        task = task.evolve(media_probe=probe)
+        required = self.estimate(stage, probe)
+        key = self._key(stage, task)
+        with self._lock:
+            ledger = self._read()
+            reservations = ledger["reservations"]
+            waiting = ledger["waiting"]
+            now = time.time()
+            used = sum([v["bytes"] for v in reservations.values()])
+            # 長く待っているタスクがある場合は、最も長く待っているタスクの分の空きを残す
+            starving = [
+                k for k, v in waiting.items() if now - v["since"] >= MEMORY_STARVATION_SECONDS
+            ]
+            oldest = min(starving, key=lambda k: waiting[k]["since"]) if starving else None
+            reserved = waiting[oldest]["bytes"] if oldest not in [None, key] else 0
+            # 予約が1つもない場合は、予算を超えても始めさせる（長く待っているタスクがあれば、そちらを先にする）
+            if used + required + reserved > self._budget_bytes and (
+                reservations or reserved > 0
+            ):
+                logger.info(
+                    f"{task.id_} - not admitted to {stage}: required={required}, used={used}, reserved={reserved}, budget={self._budget_bytes}"
+                )
+                since = waiting.get(key, {}).get("since", now)
+                waiting[key] = dict(
+                    bytes=required,
+                    since=since,
+                    expires_at=now + MEMORY_WAITING_SECONDS,
+                )
+                self._write(ledger)
+                return task, False
+            waiting.pop(key, None)
+            reservations[key] = dict(
+                bytes=required,
+                expires_at=now + MEMORY_RESERVATION_SECONDS,
+            )
+            self._write(ledger)
+        return task, True
+
+    def release(self, stage: str, task: Task):
+        """
+        予約と待っている記録を消す
+        ワーカーが処理を終えたときのほか、異常終了したワーカーや止めたワーカーの分はSupervisorが呼ぶ
+        """
+        if stage not in MEMORY_FACTORS:
+            return
+        key = self._key(stage, task)
+        with self._lock:
+            ledger = self._read()
+            reserved = ledger["reservations"].pop(key, None)
+            waited = ledger["waiting"].pop(key, None)
+            if reserved is not None or waited is not None:
+                self._write(ledger)
@@ -0,0 +1,63 @@
+import os
+import shutil
+from typing import List, Union
+
+from src.config import ARTIFACT_DIR
+from src.functions.model import Transcription
+from src.functions.utils import TranscriptTable
+from src.model import Task
+
+
+def _get_artifact_dir(task_id: str) -> str:
+    return os.path.join(ARTIFACT_DIR, task_id)
+
+
+def save_transcriptions(task_id: str, transcriptions: List[Transcription]) -> str:
+    """
+    文字起こし結果をファイルに保存して、そのパスを返す関数
+    プロセス間のキューにはパスだけを流し、必要な処理でload_transcriptionsで読み込む
+    特徴量を含めて列形式（TranscriptTable）のnpzで保存する
+
+    Args:
+        task_id (str): タスクのID
+        transcriptions (List[Transcription]): 文字起こし結果
+
+    Returns:
+        str: 保存したファイルのパス
+    """
+    artifact_dir = _get_artifact_dir(task_id)
+    os.makedirs(artifact_dir, exist_ok=True)
+    file_path = os.path.join(artifact_dir, "transcriptions.npz")
+    # 書き込み途中のファイルを読まないように、一時ファイルに書いてから置き換える
+    tmp_file_path = file_path + ".tmp"
+    TranscriptTable.from_transcriptions(transcriptions).save(tmp_file_path)
+    os.replace(tmp_file_path, file_path)
+    return file_path
+
+
+def load_transcriptions(task: Task) -> Union[List[Transcription], None]:
+    """
+    タスクの文字起こし結果を返す関数
+    taskが直接持っている場合はそれを、ファイルに保存されている場合は読み込んで返す
+
+    Args:
+        task (Task): タスク
+
+    Returns:
+        List[Transcription] | None: 文字起こし結果
+    """
+    if task.transcriptions is not None:
+        return task.transcriptions
+    if not task.transcriptions_file_path:
+        return None
+    return TranscriptTable.load(task.transcriptions_file_path).to_transcriptions()
+
+
+def remove_artifacts(task_id: str):
+    """
+    タスクの一時データを削除する関数
+
+    Args:
+        task_id (str): タスクのID
+    """
+    shutil.rmtree(_get_artifact_dir(task_id), ignore_errors=True)
@@ -1,7 +1,104 @@
+import os
+import tempfile
 from enum import Enum
 
 AUDIO_DIR = r"C:\Windows\Temp\audio"
 SPLIT_AUDIO_DIR = r"C:\Windows\Temp\split_audio"
+# 文字起こし結果など、キューで受け渡すには大きいデータの保存先
+ARTIFACT_DIR = r"C:\Windows\Temp\artifact"
+# 文字起こし結果を、結果ファイルとは別のgzipファイル（*.transcriptions.json.gz）に保存する
+SAVE_TRANSCRIPTIONS_SEPARATELY = False
+# 結果の保存と清掃処理を並列に行うスレッド数
+NUM_RESULT_COLLECTORS = 4
+# キューに溜められるタスクの数（満杯になったら前の処理が空くまで待つ）
+# media_to_audioのキューが満杯の場合は、新しいメディアはディスクに残したまま、FairSchedulerで順番を待たせる
+QUEUE_MAXSIZE = {
+    "media_to_audio": 4,
+    "audio_split": 4,
+    "transcription": 8,
+    "summarization": 8,
+    "result": 16,
+}
+
+########
+# 複数マシンでの処理
+########
+# 複数のマシンで同じroot_dirを監視する場合に、root_dir/leaseでメディアファイルごとに処理するマシンを決める
+USE_LEASE = False
+# leaseの更新間隔と、更新が途絶えてから別のマシンが引き継ぐまでの時間
+LEASE_HEARTBEAT_SECONDS = 30.0
+LEASE_TTL_SECONDS = 5 * 60.0
+
+########
+# ワーカー数の自動調整
+########
+# 処理ごとのワーカー数の下限と上限
+# transcription_taskの上限は、whisperのdeploymentの同時実行数の合計（main.py参照）
+STAGE_WORKER_LIMITS = {
+    "media_to_audio_task": dict(min_workers=1, max_workers=os.cpu_count() or 4),
+    "split_audio_task": dict(min_workers=1, max_workers=4),
+    "transcription_task": dict(min_workers=1, max_workers=None),
+    "summarization_task": dict(min_workers=1, max_workers=4),
+}
+# キューの長さと処理時間を確認する間隔
+AUTOSCALE_INTERVAL_SECONDS = 10.0
+# キューで待つ時間の目安（これを超えそうならワーカーを増やす）
+AUTOSCALE_TARGET_WAIT_SECONDS = 60.0
+# キューが空のままこの時間が経ったら、ワーカーを1つ減らす
+AUTOSCALE_IDLE_SECONDS = 300.0
+# ワーカーが異常終了したときに、処理中だったタスクをやり直す回数
+MAX_TASK_RESTARTS = 1
+# 処理ごとの制限時間（超えたらワーカーを止めてタスクをエラーにする、Noneは制限なし）
+STAGE_TIMEOUT_SECONDS = {
+    "media_to_audio_task": 60 * 60.0,
+    "split_audio_task": 60 * 60.0,
+    "transcription_task": 3 * 60 * 60.0,
+    "summarization_task": 60 * 60.0,
+}
+
+########
+# メモリの予約
+########
+# media_to_audio_taskとsplit_audio_taskの前に、メディアの長さからメモリ使用量を見積もって予約する
+# 空きが足りないタスクはキューの後ろに戻し、先に小さいタスクを処理する
+USE_MEMORY_ADMISSION = True
+# すべてのワーカーで予約できるメモリの合計
+MEMORY_BUDGET_BYTES = 8 * 1024**3
+# 見積もり = 基本量 + 長さ x サンプリングレート x チャンネル数 x 2byte(16bit) x 係数
+# split_audio_taskはpydubで全体をデコードし、無音で分割したコピーも持つので係数を大きくする
+MEMORY_BASE_BYTES = 200 * 1024**2
+MEMORY_FACTORS = {
+    "media_to_audio_task": 0.1,
+    "split_audio_task": 3.0,
+}
+# 予約の記録先（すべてのワーカープロセスで共有する）
+MEMORY_LEDGER_DIR = os.path.join(tempfile.gettempdir(), "media_to_summary_memory")
+# 解放されなかった予約は、この時間で無効にする
+# （異常終了したワーカーや止めたワーカーの予約は、Supervisorが解放する）
+MEMORY_RESERVATION_SECONDS = 2 * 60 * 60.0
+# 予約できなかったタスクをキューに戻したあと、次のタスクを取るまでの待ち時間
+MEMORY_ADMISSION_RETRY_SECONDS = 5.0
+# これより長く待っているタスクがある場合は、そのタスクの分の空きを残して、ほかのタスクを後回しにする
+# （小さいタスクが続いても、大きいタスクがいつまでも始められないことがないように）
+MEMORY_STARVATION_SECONDS = 10 * 60.0
+# 待っているタスクの記録は、この時間更新されなければ無効にする（異常終了したワーカーの分）
+MEMORY_WAITING_SECONDS = 10 * 60.0
+
+########
+# スケジューリング
+########
+# 待った1秒ごとに、メディアの長さを何秒短いとみなすか
+SCHEDULER_AGING_RATE = 1.0
+# これより長く待ったタスクは、待った順に最優先で処理する
+SCHEDULER_MAX_WAIT_SECONDS = 3 * 60 * 60.0
+# 回答者ごとの処理した長さを半分にする時間（昔に多く処理した人が、ずっと後回しにならないように）
+SCHEDULER_FAIRNESS_HALF_LIFE_SECONDS = 60 * 60.0
+# FairSchedulerが預かるタスクの数の上限（超えた分は前の処理を待たせる）
+# 多く預かるほど、混んでいるときにも公平さと短いものを優先する順番が効く
+# media_to_audioは、メディアをディスクに残したままタスクだけを預かるので上限を設けない
+SCHEDULER_CAPACITY = {
+    "transcription_task": 64,
+}
 
 
 ########
@@ -5,7 +5,11 @@ from .main import (
     extract_keywords,
     get_keywords_from_document,
     recognite_speakers,
+    recognite_speakers_in_section,
+    register_speaker,
     split_audio,
+    summarize_section,
+    summarize_text_by_map_reduce,
     summarize_transcription,
     transcript_audio,
 )
@@ -1,3 +1,5 @@
+import os
+import tempfile
 from enum import Enum
 
 
@@ -29,9 +31,34 @@ OPENAI_API_WHISPER_VERSION = "2023-09-01-preview"
 OPENAI_USE_AZURE = True
 DEFAULT_LANGUAGE = "ja"
 
+# whisperのdeployment一覧
+# 地域を追加すると、遅延・エラー率・残りのリクエスト数を見て振り分ける
+# max_concurrencyの合計が、文字起こしのワーカー数になる
+# max_concurrencyはdeploymentごとに守り、上限に達したdeploymentには振り分けない
+OPENAI_API_WHISPER_DEPLOYMENTS = [
+    dict(
+        endpoint=OPENAI_API_WHISPER_ENDPOINT,
+        deployment=OPENAI_API_WHISPER_DEPLOYMENT,
+        version=OPENAI_API_WHISPER_VERSION,
+        api_key_env="OPENAI_API_WHISPER_KEY",
+        # whisperの制限により，同時に3つまでしか処理できない
+        max_concurrency=3,
+    ),
+]
+
+# whisperのリクエストのタイムアウト（接続、レスポンスを待つ時間）
+OPENAI_API_WHISPER_CONNECT_TIMEOUT: float = 10.0
+OPENAI_API_WHISPER_TIMEOUT: float = 300.0
+
+# ffmpegで音声に変換するときのタイムアウト（超えたらffmpegを止めてエラーにする）
+FFMPEG_TIMEOUT_SECONDS: float = 30 * 60
+
 # whisperは25MBまでしか受け付けない
 MAX_FILE_SIZE_FOR_WHISPER: float = 25 * 1000 * 1000 * 0.9
 
+# whisperのpromptに入れるキーワードを、GPTを使わずにローカルで抽出する
+USE_LOCAL_KEYWORD_EXTRACTOR: bool = True
+
 # whisperに投げるときは10分までにする
 MAX_DURATION_FOR_WHISPER: float = 10 * 60
 
@@ -51,6 +78,33 @@ KEEP_SILENCE: int = 0
 # ごく短い音声を無視する
 IGNORE_DURATION_MILISECONDS: int = 300
 
+####################
+# 話者識別関連
+####################
+
+# 特徴量を計算するときのサンプリングレート
+FEATURE_SAMPLE_RATE: int = 16000
+# MFCCのフレームの間隔（サンプル数）
+FEATURE_HOP_LENGTH: int = 512
+# MFCCの次元数
+N_MFCC: int = 40
+# 話者数が指定されていない場合に試す話者数の候補
+SPEAKER_CANDIDATES = list(range(2, 11))
+# 話者識別を行う
+# 精度が低いので停止中（発話者数は継続して収集しておく）
+USE_SPEAKER_RECOGNITION: bool = False
+# sectionごとに逐次クラスタリングするときに、同じ話者とみなすcosine類似度の下限
+SPEAKER_CLUSTER_THRESHOLD: float = 0.97
+# 既知の話者の特徴量を保存するディレクトリ
+SPEAKER_INDEX_DIR = os.path.join(
+    os.path.dirname(
+        os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    ),
+    "speaker_index",
+)
+# 既知の話者とみなすcosine類似度の下限
+SPEAKER_MATCH_THRESHOLD: float = 0.95
+
 ####################
 # GPT関連
 ####################
@@ -63,8 +117,66 @@ OPENAI_API_35_ENDPOINT = "https://ed01-openai-ncus2.openai.azure.com/"
 OPENAI_API_35_MODEL = "gpt-35-turbo-16k"
 OPENAI_API_35_VERSION = "2023-07-01-preview"
 OPENAI_CHAT_TEMPERATURE = 0.0
+# ストリーミングで出力を受け取る
+# 途中で失敗した場合は、受け取った分の続きからリトライする
+OPENAI_CHAT_USE_STREAM: bool = True
+# ストリーミング時に、次のトークンが届くまで待つ秒数
+OPENAI_CHAT_STREAM_TIMEOUT: float = 30.0
+
+# 各モデルのコンテキスト長（入力と出力の合計トークン数）
+OPENAI_API_CONTEXT_LENGTH: int = 32768
+OPENAI_API_35_CONTEXT_LENGTH: int = 16384
+# メッセージの区切りなど、本文以外で消費されるトークン数の見込み
+OPENAI_CHAT_TOKEN_MARGIN: int = 256
+
+# 入力と出力のトークン数から選ぶGPTのdeployment
+# 1回のリクエストで出力まで収まる、最初のモデルを使う
+# 同じモデルのdeploymentが複数ある場合は、遅延・エラー率・残りのリクエスト数を見て振り分ける
+OPENAI_CHAT_DEPLOYMENTS = [
+    dict(
+        endpoint=OPENAI_API_35_ENDPOINT,
+        version=OPENAI_API_35_VERSION,
+        model=OPENAI_API_35_MODEL,
+        context_length=OPENAI_API_35_CONTEXT_LENGTH,
+        api_key_env="OPENAI_API_35_KEY",
+    ),
+    dict(
+        endpoint=OPENAI_API_ENDPOINT,
+        version=OPENAI_API_VERSION,
+        model=OPENAI_API_MODEL,
+        context_length=OPENAI_API_CONTEXT_LENGTH,
+        api_key_env="OPENAI_API_KEY",
+    ),
+]
 
 RETRY_COUNT = 5
+# リトライまでの待ち時間は、RETRY_BASE_SECONDS * 2**retryを上限にランダムに決める
+RETRY_BASE_SECONDS: float = 2.0
+RETRY_MAX_SECONDS: float = 60.0
+# endpointとdeploymentの組ごとに、連続で失敗した回数がこれを超えたらしばらくリクエストを止める
+CIRCUIT_BREAKER_FAILURE_THRESHOLD: int = 5
+CIRCUIT_BREAKER_RESET_SECONDS: float = 60.0
+# サーキットブレーカーの状態を全ワーカーで共有するためのディレクトリ
+CIRCUIT_BREAKER_DIR = os.path.join(tempfile.gettempdir(), "media_to_summary_circuit")
+
+# deploymentの振り分けに使う統計を全ワーカーで共有するためのディレクトリ
+DEPLOYMENT_POOL_DIR = os.path.join(tempfile.gettempdir(), "media_to_summary_pool")
+# 遅延とエラー率の指数移動平均の係数
+DEPLOYMENT_POOL_EWMA_ALPHA: float = 0.3
+# エラー率が1のとき、遅延が何倍になったとみなすか
+DEPLOYMENT_POOL_ERROR_PENALTY: float = 10.0
+# 残りのリクエスト数が0になったdeploymentを選ばない秒数
+DEPLOYMENT_POOL_THROTTLE_SECONDS: float = 10.0
+# max_concurrencyに達したdeploymentが空くのを待つ間隔
+DEPLOYMENT_POOL_WAIT_SECONDS: float = 1.0
+# ワーカーが異常終了して解放されなかった同時実行の枠は、この時間で無効にする
+# （whisperのタイムアウトより長くする）
+DEPLOYMENT_POOL_SLOT_SECONDS: float = 10 * 60.0
+
+# 文字起こしが終わったsectionから順に要約を始める
+INCREMENTAL_SUMMARIZATION: bool = True
+# 文字起こしと並行して要約するときの最大スレッド数
+INCREMENTAL_SUMMARIZATION_MAX_WORKERS: int = 2
 
 # # GPT4で文章圧縮する際の設定
 # TOKEN_SIZE_FOR_SPLIT: int = 14000
@@ -73,3 +185,24 @@ RETRY_COUNT = 5
 # GPT3.5で文章圧縮する際の設定
 TOKEN_SIZE_FOR_SPLIT: int = 2000
 TOKEN_LIMIT: int = 8000
+
+# 要約の前に、つなぎ言葉や繰り返しを取り除いてトークンを減らす
+USE_TRANSCRIPT_COMPACTION: bool = True
+# 直前と同じ発話を除外するのは、この文字数以上の場合だけ（「はい」などの短い相づちは残す）
+TRANSCRIPT_COMPACTION_DEDUPE_MIN_CHARS: int = 8
+
+# tokenizersでトークン数を数える際のtokenizer.json（Xenova/gpt-3.5-turboのものを配置する）
+# HuggingFace Hubからはダウンロードしない。ファイルがない場合は文字数で代用する
+TOKENIZER_PATH = os.path.join(
+    os.path.dirname(
+        os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    ),
+    "tokenizer",
+    "tokenizer.json",
+)
+
+# map-reduceで要約する際に、1回のリクエストに含める文章のトークン数の上限
+# 修正後の文章も同じくらいの長さになるので、GPT3.5(16k)の半分以下にする
+MAP_REDUCE_CHUNK_TOKENS: int = 6000
+# map-reduceで要約する際の最大スレッド数
+MAP_REDUCE_MAX_WORKERS: int = 4
@@ -1,24 +1,32 @@
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Union
 
 import numpy as np
 
 from src.functions.config import (
-    OPENAI_API_35_ENDPOINT,
     OPENAI_API_35_MODEL,
-    OPENAI_API_35_VERSION,
     OPENAI_API_ENDPOINT,
     OPENAI_API_MODEL,
     OPENAI_API_VERSION,
+    MAP_REDUCE_CHUNK_TOKENS,
+    MAP_REDUCE_MAX_WORKERS,
     TOKEN_LIMIT,
     TOKEN_SIZE_FOR_SPLIT,
+    USE_LOCAL_KEYWORD_EXTRACTOR,
 )
-from src.functions.model import AudioData, Speaker, Transcription
+from src.functions.model import AudioData, SectionSummary, Speaker, Transcription
 from src.functions.utils import (
     AudioSplitter,
+    OnlineSpeakerClusterer,
+    SpeakerIndex,
+    count_tokens,
     create_chat_completion,
+    extract_keywords_locally,
     get_features_of_voice,
     get_n_cluster_by_x_means,
     get_speakers_by_k_means,
+    group_indices_by_section,
+    split_text_by_tokens,
     transcript_by_whisper,
 )
 
@@ -72,13 +80,16 @@ def transcript_audio(
 def recognite_speakers(
     audio_data_list: List[AudioData],
     transcriptions: List[Transcription],
-    speakers: Union[int, tuple[int]],
+    speakers: Union[int, tuple[int], None],
+    speaker_index: Union[SpeakerIndex, None] = None,
 ) -> List[Transcription]:
     """
     話者識別の結果を反映する
     transcriptionsにあるfeaturesとkMeans++を用いて実装
     speakersがNoneと、tupleの場合はx_meansを使って話者数を推定
     speakersがintの場合は、その数の話者を想定してクラスタリング
+    speaker_indexがある場合は、先に既知の話者を引いて、見つからなかった発話だけをクラスタリングする
+    transcriptionsのstart, endは、各audio_dataの先頭からの秒数であること
     """
     try:
         features = []
@@ -89,16 +100,33 @@ def recognite_speakers(
                 audio_data.file_path,
                 [[t.start, t.end] for t in target_transcriptions],
             )
-        # クラスタリング
-        if not isinstance(speakers, int):
-            speakers = get_n_cluster_by_x_means(features, speakers)
-        speakers = get_speakers_by_k_means(features, speakers)
+        features = np.asarray(features)
+        # 既知の話者を引く
+        known_speakers: List[Union[Speaker, None]] = [None] * len(features)
+        if speaker_index is not None:
+            known_speakers = speaker_index.query(features)
+        unknown = np.array([s is None for s in known_speakers], dtype=bool)
+        # 既知の話者が見つからなかった発話をクラスタリング
+        labels = ["-"] * len(features)
+        unknown_features = features[unknown]
+        n_unknown = int(np.sum(~np.all(unknown_features == 0, axis=1)))
+        if n_unknown > 0:
+            if isinstance(speakers, int):
+                n_known = len(set([s.name for s in known_speakers if s is not None]))
+                n_cluster = max(speakers - n_known, 1)
+            else:
+                n_cluster = get_n_cluster_by_x_means(unknown_features, speakers)
+            unknown_labels = get_speakers_by_k_means(
+                unknown_features, min(n_cluster, n_unknown)
+            )
+            for i, label in zip(np.where(unknown)[0], unknown_labels):
+                labels[i] = label
         # Transcriptionにspeaker情報を追加
         new_transcriptions = []
         for i, t in enumerate(transcriptions):
             update_ = dict(
-                features=features[i],
-                speaker=Speaker(name=speakers[i]),
+                features=features[i].tolist(),
+                speaker=known_speakers[i] or Speaker(name=labels[i]),
             )
             new_transcriptions += [t.model_copy(deep=True, update=update_)]
         # ソートしてから返す
@@ -108,6 +136,68 @@ def recognite_speakers(
         return transcriptions
 
 
+def recognite_speakers_in_section(
+    audio_data: AudioData,
+    transcriptions: List[Transcription],
+    clusterer: OnlineSpeakerClusterer,
+    speaker_index: Union[SpeakerIndex, None] = None,
+) -> List[Transcription]:
+    """
+    1つのsectionの話者識別を行う
+    文字起こしが終わったsectionから順に呼び出すと、clustererの話者の重心が更新されていくので、
+    全sectionをまとめてクラスタリングし直さなくても、sectionをまたいで同じラベルがつく
+    transcriptionsのstart, endは、audio_dataの先頭からの秒数であること
+    """
+    try:
+        features = np.asarray(
+            get_features_of_voice(
+                audio_data.file_path,
+                [[t.start, t.end] for t in transcriptions],
+            )
+        )
+        known_speakers: List[Union[Speaker, None]] = [None] * len(features)
+        if speaker_index is not None:
+            known_speakers = speaker_index.query(features)
+        unknown = [i for i, s in enumerate(known_speakers) if s is None]
+        labels = ["-"] * len(features)
+        if unknown:
+            for i, label in zip(
+                unknown, clusterer.partial_fit_predict(features[unknown])
+            ):
+                labels[i] = label
+        return [
+            t.model_copy(
+                update=dict(
+                    features=features[i].tolist(),
+                    speaker=known_speakers[i] or Speaker(name=labels[i]),
+                )
+            )
+            for i, t in enumerate(transcriptions)
+        ]
+    except Exception as e:
+        return transcriptions
+
+
+def register_speaker(
+    speaker: Speaker,
+    file_path: str,
+    start_and_ends: List[List[float]],
+    speaker_index: Union[SpeakerIndex, None] = None,
+) -> bool:
+    """
+    音声ファイルのstartとendの間の発話から特徴量を作って、既知の話者として登録する
+    特徴量が作れなかった（区間が空、ファイルが読めないなど）場合はFalseを返す
+    """
+    features = np.asarray(get_features_of_voice(file_path, start_and_ends))
+    features = features[~np.all(features == 0, axis=1)]
+    if len(features) == 0:
+        return False
+    if speaker_index is None:
+        speaker_index = SpeakerIndex()
+    speaker_index.add(speaker, np.mean(features, axis=0))
+    return True
+
+
 def get_keywords_from_document(
     file_path: str,
 ) -> str:
@@ -125,9 +215,17 @@ def get_keywords_from_document(
     return extract_keywords(text, max(len(text) // 500, 5))
 
 
-def extract_keywords(transcript_text: str, num_of_keywords: int = 5) -> str:
+def extract_keywords(
+    transcript_text: str,
+    num_of_keywords: int = 5,
+    use_local: Union[bool, None] = None,
+) -> str:
+    use_local = USE_LOCAL_KEYWORD_EXTRACTOR if use_local is None else use_local
     if len(transcript_text) < 25:
         return transcript_text
+    # 文字起こしの前に呼ばれるので、GPTの応答を待たずにローカルで抽出する
+    if use_local:
+        return extract_keywords_locally(transcript_text, num_of_keywords)
     system_prompt = f"""
     You are highly skilled AI trained to extract important keywords or abstract words from a given text.
     """
@@ -173,7 +271,7 @@ def extract_keywords(transcript_text: str, num_of_keywords: int = 5) -> str:
         {"role": "assistant", "content": a_2},
         {"role": "user", "content": transcript_text},
     ]
-    keywords = create_chat_completion(messages)
+    keywords = create_chat_completion(messages, expected_output_tokens=200)
     try:
         keywords = keywords.split(",")[:num_of_keywords]
         return ", ".join(keywords)
@@ -197,47 +295,78 @@ def correct_transcription(keywords: str, transcript_text: str):
     return keywords
 
 
+def summarize_section(
+    transcriptions: List[Transcription],
+    use_gpt_4: bool = False,
+) -> SectionSummary:
+    """
+    1つのsectionの文字起こしを要約する
+    文字起こしが終わったsectionから順に呼び出せるように、summarize_transcriptionから分離している
+    """
+    summary = __summarize_text(transcriptions, use_gpt_4=use_gpt_4)
+    return SectionSummary(
+        section=transcriptions[0].section,
+        start=min([t.start for t in transcriptions]),
+        end=max([t.end for t in transcriptions]),
+        summary=summary,
+    )
+
+
 def summarize_transcription(
     transcriptions: List[Transcription],
     add_title: bool,
     add_todo: bool,
+    section_summaries: Union[List[SectionSummary], None] = None,
 ):
+    """
+    sectionごとの要約を結合して、必要に応じてタイトルとTODOを追加する
+    section_summariesに要約済みのsectionがある場合は、そのsectionの要約は再利用する
+    """
     summary_header = "## 要約 \n\n"
-    summaries = []
+    summaries: List[SectionSummary] = []
+    done = {s.section: s for s in section_summaries or [] if s.summary is not None}
     # sectionごとに要約を行う
-    unique_sections = sorted(list(set([t.section for t in transcriptions])))
+    # sectionごとの分割は、sectionの配列から1回で行う
+    groups = group_indices_by_section([t.section for t in transcriptions])
+    unique_sections = list(groups.keys())
     for section in unique_sections:
-        target_transcriptions = [t for t in transcriptions if t.section == section]
+        if section in done:
+            summaries.append(done[section])
+            continue
+        target_transcriptions = [transcriptions[i] for i in groups[section]]
         # sectionが1つの場合は、GPT-4を使って要約を行う
-        if len(unique_sections) == 1:
-            summary = __summarize_text(target_transcriptions, use_gpt_4=True)
-        else:
-            summary = __summarize_text(target_transcriptions)
-        # 開始時間と終了時間を取得
-        start = min([t.start for t in target_transcriptions])
-        end_time = max([t.end for t in target_transcriptions])
-        start_str = f"{str(int(start//60)).zfill(2)}:{str(int(start%60)).zfill(2)}"
-        end_str = f"{str(int(end_time//60)).zfill(2)}:{str(int(end_time%60)).zfill(2)}"
-        # 要約結果を追加
-        summaries.append({"start": start_str, "end": end_str, "summary": summary})
+        summaries.append(
+            summarize_section(
+                target_transcriptions, use_gpt_4=len(unique_sections) == 1
+            )
+        )
     summary_text = summary_header + "\n\n".join(
         [
-            f"### {summary['start']} - {summary['end']}\n\n{summary['summary']}"
-            # f"### {i+1} / {len(summaries)}\n\n{summary['summary']}"
+            f"### {__format_time(summary.start)} - {__format_time(summary.end)}\n\n{summary.summary}"
+            # f"### {i+1} / {len(summaries)}\n\n{summary.summary}"
             for i, summary in enumerate(summaries)
         ]
     )
-    if add_title:
-        title_header = "## タイトル \n\n"
-        title = __create_title("\n".join([summary["summary"] for summary in summaries]))
-        summary_text = title_header + title + "\n\n" + summary_text
-    if add_todo:
-        todo_header = "\n\n## TODO \n\n"
-        todo = __create_todos("\n".join([summary["summary"] for summary in summaries]))
-        summary_text += todo_header + todo
+    # タイトルとTODOは同じ入力から作るので、並列にリクエストする
+    text = "\n".join([str(summary.summary) for summary in summaries])
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        title_future = executor.submit(__create_title, text) if add_title else None
+        todo_future = executor.submit(__create_todos, text) if add_todo else None
+        if title_future is not None:
+            title_header = "## タイトル \n\n"
+            title = title_future.result()
+            summary_text = title_header + title + "\n\n" + summary_text
+        if todo_future is not None:
+            todo_header = "\n\n## TODO \n\n"
+            todo = todo_future.result()
+            summary_text += todo_header + todo
     return summary_text
 
 
+def __format_time(seconds: float) -> str:
+    return f"{str(int(seconds//60)).zfill(2)}:{str(int(seconds%60)).zfill(2)}"
+
+
 def __create_title(text: str):
     system_prompt = f"""
     I'm highly skilled AI tranined to generate a simple and easy-to-understand title from given summary in Japanese.
@@ -256,7 +385,7 @@ def __create_title(text: str):
         {"role": "assistant", "content": a_2},
         {"role": "user", "content": text},
     ]
-    return create_chat_completion(messages)
+    return create_chat_completion(messages, expected_output_tokens=200)
 
 
 def __create_todos(text: str):
@@ -273,35 +402,81 @@ def __create_todos(text: str):
         {"role": "assistant", "content": a_1},
         {"role": "user", "content": text},
     ]
-    return create_chat_completion(messages)
+    return create_chat_completion(messages, expected_output_tokens=1000)
 
 
 def __summarize_text(
     transcriptions: List[Transcription],
     use_gpt_4: bool = False,
 ):
-    openai_api_endpoint = OPENAI_API_35_ENDPOINT if use_gpt_4 else None
-    openai_api_version = OPENAI_API_35_VERSION if use_gpt_4 else None
+    # モデルだけ指定して、deploymentはリクエストごとに振り分ける
     openai_api_model = OPENAI_API_35_MODEL if use_gpt_4 else None
+    openai_kwargs = dict(openai_api_model=openai_api_model)
+    keywords = transcriptions[0].keywords
+    texts = [t.text for t in transcriptions]
+    # 1回のリクエストに収まる場合は、そのまま修正と要約を行う
+    if count_tokens(" ".join(texts)) <= MAP_REDUCE_CHUNK_TOKENS:
+        return __correct_and_summarize(" ".join(texts), keywords, **openai_kwargs)
+    return summarize_text_by_map_reduce(texts, keywords, **openai_kwargs)
+
+
+def summarize_text_by_map_reduce(
+    texts: List[str],
+    keywords: str,
+    chunk_tokens: Union[int, None] = None,
+    max_workers: Union[int, None] = None,
+    **openai_kwargs,
+):
+    """
+    長い文字起こしをmap-reduceで要約する
+    textsをトークン数で詰めてchunkにし、chunkごとの修正と要約を並列に行ったあと(map)、
+    要約をトークン数の上限まで束ねてまとめる処理を、1つになるまで木構造で繰り返す(reduce)
+    """
+    chunk_tokens = chunk_tokens or MAP_REDUCE_CHUNK_TOKENS
+    max_workers = max_workers or MAP_REDUCE_MAX_WORKERS
+    chunks = split_text_by_tokens(texts, chunk_tokens)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        summaries = list(
+            executor.map(
+                lambda chunk: __correct_and_summarize(chunk, keywords, **openai_kwargs),
+                chunks,
+            )
+        )
+        summaries = [summary or "" for summary in summaries]
+        while len(summaries) > 1:
+            # 要約は途中で分けずに、そのまま束ねる
+            groups = split_text_by_tokens(
+                summaries, chunk_tokens, separator="\n", split_long_text=False
+            )
+            # 要約が長くて束ねられない場合でも、2つずつまとめて必ず数を減らす
+            if len(groups) >= len(summaries):
+                groups = [
+                    "\n".join(summaries[i : i + 2]) for i in range(0, len(summaries), 2)
+                ]
+            summaries = list(
+                executor.map(
+                    lambda group: __merge_summaries(group, **openai_kwargs) or "",
+                    groups,
+                )
+            )
+    return summaries[0]
+
+
+def __correct_and_summarize(text: str, keywords: str, **openai_kwargs):
     # 先に文字起こしの修正を行う
     system_prompt_1 = f"""  
     You are a highly skilled AI. 
     Your task is to analyze the following transcription, correct misspelled words and grammatical errors, and output the corrected transcription.
     For correstion, take into account the following keywords, which is extracted from the transcription.
-    keywords: {transcriptions[0].keywords}
+    keywords: {keywords}
     Output in JAPANESE.
     here is the transcription:
     """
     messages = [
         {"role": "system", "content": system_prompt_1},
-        {"role": "user", "content": " ".join([t.text for t in transcriptions])},
+        {"role": "user", "content": text},
     ]
-    corrected_text = create_chat_completion(
-        messages,
-        openai_api_endpoint=openai_api_endpoint,
-        openai_api_version=openai_api_version,
-        openai_api_model=openai_api_model,
-    )
+    corrected_text = create_chat_completion(messages, **openai_kwargs)
     # そのあとに要約を行う
     system_prompt_2 = f"""
     You are a highly skilled AI. Your task is to analyze the following transcription, summarize it without losing any important information, and present the summary in markdown bullet points in Japanese. When possible, include specific numbers, expressions, and examples from the transcription in your summary. Here is the transcription:
@@ -310,15 +485,28 @@ def __summarize_text(
         {"role": "system", "content": system_prompt_2},
         {"role": "user", "content": corrected_text},
     ]
+    # 要約は修正後の文章の半分もあれば収まる
     summary = create_chat_completion(
         messages,
-        openai_api_endpoint=openai_api_endpoint,
-        openai_api_version=openai_api_version,
-        openai_api_model=openai_api_model,
+        expected_output_tokens=count_tokens(corrected_text or "") // 2,
+        **openai_kwargs,
     )
     return summary
 
 
+def __merge_summaries(text: str, **openai_kwargs):
+    system_prompt = f"""
+    You are a highly skilled AI. The following text consists of summaries of consecutive parts of a single transcription. Your task is to merge them into one summary without losing any important information, and present the summary in markdown bullet points in Japanese. Keep specific numbers, expressions, and examples. Here are the summaries:
+    """
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": text},
+    ]
+    return create_chat_completion(
+        messages, expected_output_tokens=count_tokens(text) // 2, **openai_kwargs
+    )
+
+
 # 今は使っていない
 def compress_text(
     transcriptions: List[Transcription],
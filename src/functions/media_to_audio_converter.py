@@ -1,11 +1,20 @@
 import os
+import subprocess
+from typing import Union
 
 import ffmpeg  # type: ignore
+from src.functions.config import FFMPEG_TIMEOUT_SECONDS
+from src.functions.model import MediaProbe
 from src.functions.utils import set_path_for_ffmpeg_bin
 
 
 class MediaToAudioConverter:
-    def convert(self, media_file_path: str, audio_file_path: str):
+    def convert(
+        self,
+        media_file_path: str,
+        audio_file_path: str,
+        timeout: Union[float, None] = None,
+    ):
         # 動画ファイルが入力された場合は，音声ファイルに変換する
         # 音声ファイルが入力された場合は，そのまま返す
         # 条件分岐が必要かと思いきや、ffmpegは動画ファイルを入力すると音声ファイルに変換してくれるし、
@@ -14,11 +23,33 @@ class MediaToAudioConverter:
         self.__convert(
             media_file_path=media_file_path,
             audio_file_path=audio_file_path,
+            timeout=timeout or FFMPEG_TIMEOUT_SECONDS,
         )
         return audio_file_path
 
     @staticmethod
-    def __convert(media_file_path: str, audio_file_path: str):
+    def probe(file_path: str) -> MediaProbe:
+        """
+        メディアファイルの長さ、チャンネル数、サンプリングレートをffprobeで調べる
+        """
+        base_dir = os.path.dirname(os.path.dirname(__file__))
+        set_path_for_ffmpeg_bin(base_dir)
+        probe = ffmpeg.probe(file_path)
+        audio_streams = [
+            stream for stream in probe["streams"] if stream["codec_type"] == "audio"
+        ]
+        audio_stream = audio_streams[0] if audio_streams else {}
+        duration = probe.get("format", {}).get("duration") or audio_stream.get(
+            "duration"
+        )
+        return MediaProbe(
+            duration=float(duration or 0.0),
+            channels=int(audio_stream.get("channels") or 2),
+            sample_rate=int(audio_stream.get("sample_rate") or 44100),
+        )
+
+    @staticmethod
+    def __convert(media_file_path: str, audio_file_path: str, timeout: float):
         # async def __convert(media_file_path: str, audio_file_path: str):
         base_dir = os.path.dirname(os.path.dirname(__file__))
         set_path_for_ffmpeg_bin(base_dir)
@@ -28,7 +59,16 @@ class MediaToAudioConverter:
         # stream = ffmpeg.filter(stream, "loudnorm")
         ext = audio_file_path.split(".")[-1]
         stream = ffmpeg.output(stream, audio_file_path, format=ext)
-        ffmpeg.run(stream, overwrite_output=True)
+        # 壊れたファイルなどでffmpegが終わらない場合に備えて、timeoutを過ぎたら止める
+        process = ffmpeg.run_async(stream, overwrite_output=True, pipe_stderr=True)
+        try:
+            _, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            raise TimeoutError(f"ffmpeg did not finish in {timeout} seconds")
+        if process.returncode != 0:
+            raise ffmpeg.Error("ffmpeg", None, stderr)
         return
 
     @staticmethod
@@ -1,3 +1,6 @@
 from .speaker import Speaker  # isort:skip
 from .audio_data import AudioData  # isort:skip
 from .transcription import Transcription  # isort:skip
+from .section_summary import SectionSummary  # isort:skip
+from .compaction_stats import CompactionStats  # isort:skip
+from .media_probe import MediaProbe  # isort:skip
@@ -0,0 +1,10 @@
+from pydantic import BaseModel
+
+
+class CompactionStats(BaseModel):
+    segments_before: int = 0
+    segments_after: int = 0
+    chars_before: int = 0
+    chars_after: int = 0
+    tokens_before: int = 0
+    tokens_after: int = 0
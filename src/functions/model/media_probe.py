@@ -0,0 +1,8 @@
+from pydantic import BaseModel
+
+
+class MediaProbe(BaseModel):
+    # 秒
+    duration: float = 0.0
+    channels: int = 2
+    sample_rate: int = 44100
@@ -0,0 +1,11 @@
+from typing import Union
+
+from pydantic import BaseModel
+
+
+class SectionSummary(BaseModel):
+    section: int
+    start: float = 0.0
+    end: float = 0.0
+    # 要約に失敗した場合はNone
+    summary: Union[str, None] = None
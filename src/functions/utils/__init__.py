@@ -1,5 +1,8 @@
 from .utils_ import (  # isort:skip
+    count_tokens,
     create_chat_completion,
+    route_chat_deployment,
+    split_text_by_tokens,
     set_path_for_ffmpeg_bin,
     transcript_by_whisper,
     get_features_of_voice,
@@ -8,3 +11,9 @@ from .utils_ import (  # isort:skip
 )
 
 from .audio_splitter import AudioSplitter  # isort:skip
+from .resilience import CircuitBreaker, call_with_retry  # isort:skip
+from .keyword_extractor import extract_keywords_locally  # isort:skip
+from .transcript_compactor import compact_transcriptions, measure_compaction  # isort:skip
+from .speaker_index import SpeakerIndex  # isort:skip
+from .online_speaker_clusterer import OnlineSpeakerClusterer  # isort:skip
+from .transcript_table import TranscriptTable, group_indices_by_section  # isort:skip
@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import random
+import time
+import uuid
+from typing import Dict, List, Union
+
+from filelock import FileLock
+
+from src.functions.config import (
+    DEPLOYMENT_POOL_DIR,
+    DEPLOYMENT_POOL_ERROR_PENALTY,
+    DEPLOYMENT_POOL_EWMA_ALPHA,
+    DEPLOYMENT_POOL_SLOT_SECONDS,
+    DEPLOYMENT_POOL_THROTTLE_SECONDS,
+    DEPLOYMENT_POOL_WAIT_SECONDS,
+)
+from src.functions.utils.resilience import CircuitBreaker, deployment_key
+
+
+class DeploymentPool:
+    """
+    同じ役割のdeploymentの一覧から、遅延・エラー率・残りのリクエスト数を見てリクエスト先を選ぶ
+    統計はファイルに保存するので、すべてのワーカープロセスで共有される
+    max_concurrencyがあるdeploymentは、処理中のリクエスト数（in_flight）も記録して上限を守る
+    """
+
+    def __init__(
+        self,
+        name: str,
+        deployments: List[Dict],
+        state_dir: Union[str, None] = None,
+    ):
+        self._deployments = deployments
+        state_dir = state_dir or DEPLOYMENT_POOL_DIR
+        os.makedirs(state_dir, exist_ok=True)
+        file_name = hashlib.md5(name.encode()).hexdigest()
+        self._state_file_path = os.path.join(state_dir, f"{file_name}.json")
+        self._lock = FileLock(self._state_file_path + ".lock")
+        # acquireで取った枠（deploymentのキー -> 枠のid）
+        self._slots: Dict[str, List[str]] = {}
+
+    @staticmethod
+    def _key(deployment: Dict) -> str:
+        return deployment_key(deployment)
+
+    def _read(self) -> Dict[str, Dict]:
+        try:
+            with open(self._state_file_path, "r", encoding="UTF-8") as f:
+                return json.load(f)
+        except Exception:
+            return {}
+
+    def _write(self, state: Dict[str, Dict]):
+        with open(self._state_file_path, "w", encoding="UTF-8") as f:
+            json.dump(state, f)
+
+    @staticmethod
+    def _in_flight(stats: Dict, now: float) -> int:
+        # 期限切れの枠（異常終了したワーカーの分）は数えない
+        return len([v for v in stats.get("in_flight", {}).values() if v > now])
+
+    @staticmethod
+    def _is_limited(deployment: Dict) -> bool:
+        return bool(deployment.get("max_concurrency"))
+
+    def _update(self, deployment: Dict, **kwargs):
+        with self._lock:
+            state = self._read()
+            stats = state.get(self._key(deployment), {})
+            alpha = DEPLOYMENT_POOL_EWMA_ALPHA
+            for k, v in kwargs.items():
+                # latencyとerror_rateは指数移動平均で更新する
+                if k in ["latency", "error_rate"] and stats.get(k) is not None:
+                    v = (1 - alpha) * stats[k] + alpha * v
+                stats[k] = v
+            state[self._key(deployment)] = stats
+            self._write(state)
+
+    def _select(self, state: Dict[str, Dict], now: float) -> Union[Dict, None]:
+        """
+        スコア（遅延 * (1 + エラー率のペナルティ)）の逆数に比例した確率でdeploymentを選ぶ
+        max_concurrencyに達しているdeploymentは選ばず、すべて達している場合はNoneを返す
+        制限中やサーキットブレーカーが開いているdeploymentは、ほかに候補がある限り選ばない
+        統計がないdeploymentは、一番速いものと同じ遅延とみなして試す
+        """
+        available = [
+            d
+            for d in self._deployments
+            if not self._is_limited(d)
+            or self._in_flight(state.get(self._key(d), {}), now) < d["max_concurrency"]
+        ]
+        if not available:
+            return None
+        latencies = [s["latency"] for s in state.values() if s.get("latency")]
+        default_latency = min(latencies) if latencies else 1.0
+        candidates = []
+        weights = []
+        for deployment in available:
+            stats = state.get(self._key(deployment), {})
+            if stats.get("throttled_until", 0) > now:
+                continue
+            if CircuitBreaker(self._key(deployment)).is_open():
+                continue
+            latency = stats.get("latency") or default_latency
+            error_rate = stats.get("error_rate") or 0.0
+            score = latency * (1 + DEPLOYMENT_POOL_ERROR_PENALTY * error_rate)
+            candidates.append(deployment)
+            weights.append(1 / max(score, 1e-3))
+        if not candidates:
+            # すべて使えない場合は、制限が早く解除されるものを選ぶ
+            return min(
+                available,
+                key=lambda d: state.get(self._key(d), {}).get("throttled_until", 0),
+            )
+        return random.choices(candidates, weights=weights)[0]
+
+    def acquire(self) -> Dict:
+        """
+        deploymentを選び、max_concurrencyがある場合は処理中の枠を1つ取る
+        すべてのdeploymentが上限に達している場合は、空くまで待つ
+        使い終わったら、成功・失敗にかかわらずreleaseを呼ぶ
+        """
+        if len(self._deployments) == 1 and not self._is_limited(self._deployments[0]):
+            return self._deployments[0]
+        while True:
+            with self._lock:
+                state = self._read()
+                now = time.time()
+                deployment = self._select(state, now)
+                if deployment is not None:
+                    if self._is_limited(deployment):
+                        key = self._key(deployment)
+                        stats = state.get(key, {})
+                        in_flight = {
+                            k: v for k, v in stats.get("in_flight", {}).items() if v > now
+                        }
+                        slot = uuid.uuid4().hex
+                        in_flight[slot] = now + DEPLOYMENT_POOL_SLOT_SECONDS
+                        stats["in_flight"] = in_flight
+                        state[key] = stats
+                        self._write(state)
+                        self._slots.setdefault(key, []).append(slot)
+                    return deployment
+            time.sleep(DEPLOYMENT_POOL_WAIT_SECONDS)
+
+    def release(self, deployment: Dict):
+        key = self._key(deployment)
+        slots = self._slots.get(key)
+        if not slots:
+            return
+        slot = slots.pop()
+        with self._lock:
+            state = self._read()
+            stats = state.get(key, {})
+            if stats.get("in_flight", {}).pop(slot, None) is not None:
+                self._write(state)
+
+    def record_success(self, deployment: Dict, latency: float):
+        self._update(deployment, latency=latency, error_rate=0.0)
+
+    def record_failure(self, deployment: Dict, retry_after: Union[float, None] = None):
+        update_ = dict(error_rate=1.0)
+        if retry_after is not None:
+            update_["throttled_until"] = time.time() + retry_after
+        self._update(deployment, **update_)
+
+    def record_headers(self, deployment: Dict, headers):
+        """
+        レスポンスヘッダーの残りのリクエスト数を記録する
+        残りが0の場合は、しばらくそのdeploymentを選ばない
+        """
+        try:
+            remaining = headers.get("x-ratelimit-remaining-requests")
+            if remaining is None:
+                return
+            update_ = dict(remaining_requests=int(remaining))
+            if int(remaining) <= 0:
+                update_["throttled_until"] = time.time() + DEPLOYMENT_POOL_THROTTLE_SECONDS
+            self._update(deployment, **update_)
+        except Exception:
+            return
@@ -0,0 +1,97 @@
+import math
+import re
+import unicodedata
+from collections import Counter
+from typing import Dict, List
+
+# 漢字・カタカナ・英数字が続く部分を複合語の候補とする
+# ひらがなは助詞や活用語尾であることが多いので、区切りとして扱う
+_CANDIDATE_PATTERN = re.compile(r"[一-龥々〆ヵヶァ-ヴーA-Za-z0-9&\.\-]+")
+_SENTENCE_PATTERN = re.compile(r"[。！？!?\n]+")
+_KATAKANA_OR_ALPHABET_PATTERN = re.compile(r"[ァ-ヴーA-Za-z]")
+
+# 会話によく出てくるが、キーワードにはならない語
+STOP_WORDS = {
+    "今日",
+    "今回",
+    "場合",
+    "感じ",
+    "部分",
+    "自分",
+    "時間",
+    "一番",
+    "最初",
+    "最後",
+    "全部",
+    "結構",
+    "本当",
+    "大丈夫",
+    "確認",
+    "よろしく",
+    "お願い",
+    "以上",
+    "関係",
+    "状況",
+    "必要",
+}
+
+
+def _split_candidates(text: str) -> List[str]:
+    candidates = []
+    for word in _CANDIDATE_PATTERN.findall(text):
+        word = word.strip(".-&")
+        # 1文字の語や数字だけの語は除外する
+        if len(word) < 2 or word.isdigit() or word in STOP_WORDS:
+            continue
+        candidates.append(word)
+    return candidates
+
+
+def score_keywords(text: str) -> Dict[str, float]:
+    """
+    文章中の複合語の候補にスコアをつける
+    出現回数(tf)に加えて、文章全体に散らばっている語、長い語、カタカナ・英字を含む語（固有名詞や専門用語）を重視する
+    """
+    text = unicodedata.normalize("NFKC", text)
+    sentences = [s for s in _SENTENCE_PATTERN.split(text) if s.strip()]
+    if not sentences:
+        return {}
+    tf: Counter = Counter()
+    df: Counter = Counter()
+    first_position: Dict[str, int] = {}
+    for i, sentence in enumerate(sentences):
+        candidates = _split_candidates(sentence)
+        tf.update(candidates)
+        df.update(set(candidates))
+        for candidate in candidates:
+            first_position.setdefault(candidate, i)
+    scores = {}
+    for word, count in tf.items():
+        spread = df[word] / len(sentences)
+        length_weight = math.log(1 + len(word))
+        position_weight = 1 + 1 / (1 + first_position[word])
+        type_weight = 1.5 if _KATAKANA_OR_ALPHABET_PATTERN.search(word) else 1.0
+        scores[word] = (
+            (1 + math.log(count))
+            * (1 + spread)
+            * length_weight
+            * position_weight
+            * type_weight
+        )
+    return scores
+
+
+def extract_keywords_locally(text: str, num_of_keywords: int = 5) -> str:
+    """
+    GPTを使わずに、文章からキーワードを抽出して", "区切りで返す
+    上位の語に含まれる短い語は、同じ意味の重複とみなして除外する
+    """
+    scores = score_keywords(text)
+    keywords: List[str] = []
+    for word in sorted(scores, key=lambda w: scores[w], reverse=True):
+        if any(word in keyword for keyword in keywords):
+            continue
+        keywords.append(word)
+        if len(keywords) >= num_of_keywords:
+            break
+    return ", ".join(keywords)
@@ -0,0 +1,173 @@
+from typing import Dict, List, Set, Union
+
+import numpy as np
+from sklearn.cluster import KMeans
+
+from src.functions.config import SPEAKER_CANDIDATES, SPEAKER_CLUSTER_THRESHOLD
+from src.functions.utils.utils_ import get_n_cluster_by_x_means
+
+
+class OnlineSpeakerClusterer:
+    """
+    sectionごとに届く発話の特徴量で、話者の重心を逐次更新しながらラベルをつける
+    一度作った重心の番号は変わらないので、sectionをまたいでもラベル（A, B, C...）は一貫する
+    計算量は発話数に比例する
+
+    - 最初のsectionで、話者数をx-means（話者数が指定されている場合はその数）で決めてk-meansで重心を作る
+    - 以降のsectionは、既存の重心とのcosine類似度がthreshold以上なら、その話者とみなして重心を更新する
+    - 届かない場合は、話者数の上限まで新しい話者を作り、上限に達した後は最も近い話者に割り当てる
+    - 重心どうしのcosine類似度がthreshold以上になったら、同じ話者としてまとめる
+      前のsectionで返したラベルが変わらないように、まとめて消すのはラベルとして返したことがない話者だけにする
+      （返したことがある話者どうしはまとめない。まとめた話者の枠は空くので、後から現れた話者を新しく作れる）
+    """
+
+    def __init__(
+        self,
+        n_speakers: Union[int, List[int], None] = None,
+        threshold: Union[float, None] = None,
+    ):
+        # 話者数の候補（intの場合はその数だけ）
+        if isinstance(n_speakers, int):
+            self._n_clusters = [n_speakers]
+        else:
+            self._n_clusters = list(n_speakers or SPEAKER_CANDIDATES)
+        self._max_speakers = max(self._n_clusters)
+        self._threshold = threshold or SPEAKER_CLUSTER_THRESHOLD
+        self._sums: Union[np.ndarray, None] = None
+        self._counts: Union[np.ndarray, None] = None
+        # まとめられた話者の番号 -> まとめた先の番号
+        self._aliases: Dict[int, int] = {}
+        # ラベルとして返したことがある番号（返したことがない番号は、新しい話者に使い回す）
+        self._emitted: Set[int] = set()
+
+    @property
+    def n_speakers(self) -> int:
+        return 0 if self._counts is None else len(self._counts) - len(self._aliases)
+
+    def _active(self) -> np.ndarray:
+        return np.array(
+            [i for i in range(len(self._counts)) if i not in self._aliases], dtype=int
+        )
+
+    def _centroids(self, indices: np.ndarray) -> np.ndarray:
+        centroids = self._sums[indices] / self._counts[indices, np.newaxis]
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        return centroids / np.maximum(norms, 1e-12)
+
+    def _resolve(self, label: int) -> int:
+        while label in self._aliases:
+            label = self._aliases[label]
+        return label
+
+    def _seed(self, features: np.ndarray) -> np.ndarray:
+        """
+        最初のsectionの特徴量から話者数を決めて、k-meansで重心を作る
+        """
+        if len(self._n_clusters) == 1:
+            n_cluster = self._n_clusters[0]
+        else:
+            n_cluster = get_n_cluster_by_x_means(features, self._n_clusters)
+        n_cluster = max(min(n_cluster, len(features)), 1)
+        if n_cluster == 1:
+            labels = np.zeros(len(features), dtype=int)
+        else:
+            km = KMeans(n_clusters=n_cluster, init="k-means++", n_init=10, random_state=0)
+            labels = km.fit_predict(features)
+        self._sums = np.zeros((n_cluster, features.shape[1]))
+        np.add.at(self._sums, labels, features)
+        self._counts = np.bincount(labels, minlength=n_cluster).astype(float)
+        return labels
+
+    def _assign(self, features: np.ndarray) -> np.ndarray:
+        """
+        既存の重心に割り当て、届かない発話は話者数の上限まで新しい話者を作る
+        """
+        labels = np.full(len(features), -1)
+        # まず既存の重心にまとめて割り当てる
+        active = self._active()
+        similarities = features @ self._centroids(active).T
+        best = np.argmax(similarities, axis=1)
+        matched = (similarities[np.arange(len(features)), best] >= self._threshold) | (
+            self.n_speakers >= self._max_speakers
+        )
+        labels[matched] = active[best[matched]]
+        np.add.at(self._sums, labels[matched], features[matched])
+        np.add.at(self._counts, labels[matched], 1)
+        # 割り当てられなかった発話は、順番に新しい話者を作りながら割り当てる
+        for i in np.where(~matched)[0]:
+            active = self._active()
+            similarities = self._centroids(active) @ features[i]
+            best_ = int(np.argmax(similarities))
+            if (
+                similarities[best_] >= self._threshold
+                or self.n_speakers >= self._max_speakers
+            ):
+                labels[i] = active[best_]
+                self._sums[labels[i]] += features[i]
+                self._counts[labels[i]] += 1
+                continue
+            labels[i] = self._add_speaker(features[i])
+        return labels
+
+    def _add_speaker(self, feature: np.ndarray) -> int:
+        # まとめられた番号のうち、ラベルとして返しておらず、ほかの番号のまとめ先でもないものは使い回す
+        unused = sorted(
+            [
+                i
+                for i in self._aliases
+                if i not in self._emitted and i not in self._aliases.values()
+            ]
+        )
+        if unused:
+            label = unused[0]
+            del self._aliases[label]
+            self._sums[label] = feature
+            self._counts[label] = 1.0
+            return label
+        self._sums = np.concatenate([self._sums, feature[np.newaxis, :]])
+        self._counts = np.append(self._counts, 1.0)
+        return len(self._counts) - 1
+
+    def _merge(self):
+        """
+        cosine類似度がthreshold以上の重心の組を、なくなるまでまとめる
+        ラベルとして返したことがない方を、もう一方にまとめる（どちらも返したことがない場合は番号の大きい方）
+        """
+        while True:
+            active = self._active()
+            if len(active) < 2:
+                return
+            centroids = self._centroids(active)
+            similarities = centroids @ centroids.T
+            np.fill_diagonal(similarities, -np.inf)
+            emitted = np.array([label in self._emitted for label in active])
+            similarities[np.outer(emitted, emitted)] = -np.inf
+            i, j = np.unravel_index(np.argmax(similarities), similarities.shape)
+            if similarities[i, j] < self._threshold:
+                return
+            keep, drop = min(active[i], active[j]), max(active[i], active[j])
+            if drop in self._emitted:
+                keep, drop = drop, keep
+            self._sums[keep] += self._sums[drop]
+            self._counts[keep] += self._counts[drop]
+            self._aliases[int(drop)] = int(keep)
+
+    def partial_fit_predict(self, features: Union[np.ndarray, list]) -> List[str]:
+        """
+        1つのsectionの特徴量を受け取って、発話ごとのラベルを返す
+        特徴量がnp.zeros(40)の発話は"-"にする
+        """
+        features = np.atleast_2d(np.asarray(features, dtype=float))
+        labels = np.full(len(features), -1)
+        valid = ~np.all(features == 0, axis=1)
+        if len(features) == 0 or not np.any(valid):
+            return ["-"] * len(features)
+        if self._counts is None:
+            labels[valid] = self._seed(features[valid])
+        else:
+            labels[valid] = self._assign(features[valid])
+        # 近づいた重心をまとめ、このsectionのラベルもまとめた先の番号にする
+        self._merge()
+        labels = [self._resolve(int(label)) if label >= 0 else -1 for label in labels]
+        self._emitted.update([label for label in labels if label >= 0])
+        return [chr(65 + label) if label >= 0 else "-" for label in labels]
@@ -0,0 +1,244 @@
+import hashlib
+import json
+import os
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Union
+
+import httpx
+import openai
+import requests
+from filelock import FileLock
+
+from src.functions.config import (
+    CIRCUIT_BREAKER_DIR,
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+    CIRCUIT_BREAKER_RESET_SECONDS,
+    RETRY_BASE_SECONDS,
+    RETRY_COUNT,
+    RETRY_MAX_SECONDS,
+)
+from src.log.my_logger import MyLogger
+
+my_logger = MyLogger(__name__)
+logger = my_logger.logger
+
+# 5xxに加えて、リトライで成功する見込みがあるstatus code
+RETRYABLE_STATUS_CODES = (408, 429)
+# 通信エラーやタイムアウトなど、リトライで成功する見込みがあるエラー
+# それ以外（設定漏れのKeyErrorや、応答の形が想定と違うTypeErrorなど）はリトライしない
+RETRYABLE_EXCEPTIONS = (
+    openai.APIConnectionError,
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    httpx.TransportError,
+)
+
+
+class CircuitOpenError(Exception):
+    """
+    サーキットブレーカーが開いていて、リクエストを送らなかったときのエラー
+    """
+
+    def __init__(self, endpoint: str, retry_after: float):
+        super().__init__(f"circuit is open for {endpoint}")
+        self.retry_after = retry_after
+
+
+class TransientError(Exception):
+    """
+    通信が途中で切れたときなど、リトライで成功する見込みがあるエラー
+    """
+
+
+def deployment_key(deployment: Dict) -> str:
+    """
+    サーキットブレーカーとdeploymentの統計を分けるキー
+    同じendpoint（ホスト）でも、whisperとGPTのようにdeploymentが違えば障害や制限は別に扱う
+    """
+    return "{}|{}".format(
+        deployment["endpoint"],
+        deployment.get("deployment") or deployment.get("model"),
+    )
+
+
+def _get_response(e: Exception):
+    if isinstance(e, openai.APIStatusError):
+        return e.response
+    if isinstance(e, requests.HTTPError):
+        return e.response
+    return None
+
+
+def is_retryable(e: Exception) -> bool:
+    """
+    リトライして成功する見込みがあるエラーかどうかを判定する
+    通信エラー・タイムアウトと、status codeが408, 429, 5xxのエラーだけをリトライする
+    4xx（408, 429以外）はリクエスト自体に問題があり、それ以外の例外は手元の不具合なのでリトライしない
+    """
+    if isinstance(e, (CircuitOpenError, TransientError, *RETRYABLE_EXCEPTIONS)):
+        return True
+    response = _get_response(e)
+    if response is None:
+        return False
+    status_code = response.status_code
+    return status_code in RETRYABLE_STATUS_CODES or status_code >= 500
+
+
+def get_retry_after(e: Exception) -> Union[float, None]:
+    """
+    Retry-After（秒数または日時）とretry-after-msのヘッダーから、待つべき秒数を取得する
+    """
+    if isinstance(e, CircuitOpenError):
+        return e.retry_after
+    response = _get_response(e)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            value = headers["retry-after"]
+            if value.replace(".", "", 1).isdigit():
+                return float(value)
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except Exception:
+        return None
+    return None
+
+
+def compute_backoff(retry: int, retry_after: Union[float, None] = None) -> float:
+    """
+    指数バックオフにジッターを加えた待ち時間を計算する
+    ワーカーが同時にリトライしないように、0から上限までの一様乱数にする
+    Retry-Afterがある場合は、それより短くはしない
+    """
+    backoff = random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2**retry))
+    if retry_after is not None:
+        backoff = max(backoff, retry_after)
+    return backoff
+
+
+class CircuitBreaker:
+    """
+    endpointとdeploymentの組（deployment_key）ごとのサーキットブレーカー
+    状態はファイルに保存するので、すべてのワーカープロセスで共有される
+    連続でfailure_threshold回失敗すると開き、reset_seconds経つと1回だけ試しにリクエストを通す
+    """
+
+    def __init__(
+        self,
+        key: str,
+        failure_threshold: Union[int, None] = None,
+        reset_seconds: Union[float, None] = None,
+        state_dir: Union[str, None] = None,
+    ):
+        self._key = key
+        self._failure_threshold = failure_threshold or CIRCUIT_BREAKER_FAILURE_THRESHOLD
+        self._reset_seconds = reset_seconds or CIRCUIT_BREAKER_RESET_SECONDS
+        state_dir = state_dir or CIRCUIT_BREAKER_DIR
+        os.makedirs(state_dir, exist_ok=True)
+        name = hashlib.md5(key.encode()).hexdigest()
+        self._state_file_path = os.path.join(state_dir, f"{name}.json")
+        self._lock = FileLock(self._state_file_path + ".lock")
+
+    def _read(self) -> dict:
+        try:
+            with open(self._state_file_path, "r", encoding="UTF-8") as f:
+                return json.load(f)
+        except Exception:
+            return {"failures": 0, "opened_at": None}
+
+    def _write(self, state: dict):
+        with open(self._state_file_path, "w", encoding="UTF-8") as f:
+            json.dump(state, f)
+
+    def is_open(self) -> bool:
+        state = self._read()
+        if state["opened_at"] is None:
+            return False
+        return time.time() - state["opened_at"] < self._reset_seconds
+
+    def before_call(self):
+        """
+        開いている間はCircuitOpenErrorを送出する
+        reset_secondsが経っていれば、次に来た1回だけ通して、それ以外は待たせる
+        """
+        with self._lock:
+            state = self._read()
+            if state["opened_at"] is None:
+                return
+            elapsed = time.time() - state["opened_at"]
+            if elapsed < self._reset_seconds:
+                raise CircuitOpenError(self._key, self._reset_seconds - elapsed)
+            # half-open: 試しのリクエストが終わるまで、他のワーカーは待たせる
+            state["opened_at"] = time.time()
+            self._write(state)
+
+    def record_success(self):
+        with self._lock:
+            self._write({"failures": 0, "opened_at": None})
+
+    def record_failure(self):
+        with self._lock:
+            state = self._read()
+            state["failures"] += 1
+            if state["failures"] >= self._failure_threshold:
+                if state["opened_at"] is None:
+                    logger.warning(f"circuit opened for {self._key}")
+                state["opened_at"] = time.time()
+            self._write(state)
+
+
+def call_with_retry(
+    func: Callable,
+    endpoint: Union[str, None] = None,
+    retry_count: Union[int, None] = None,
+    pool=None,
+):
+    """
+    funcをendpointのサーキットブレーカー越しに呼び出し、失敗した場合はリトライする
+    poolを指定した場合は、試行ごとにpoolからdeploymentの枠を取ってfunc(deployment)を呼び出し、
+    deploymentごとのサーキットブレーカーを使う
+    リトライできないエラーは、サーキットブレーカーとpoolに失敗として記録せずにそのまま送出する
+    リトライできないエラーや、retry_count回失敗した場合は最後のエラーを送出する
+    """
+    retry_count = retry_count or RETRY_COUNT
+    retry = 0
+    while True:
+        deployment = pool.acquire() if pool is not None else None
+        if deployment is not None:
+            endpoint = deployment["endpoint"]
+        circuit_breaker = CircuitBreaker(
+            deployment_key(deployment) if deployment is not None else str(endpoint)
+        )
+        try:
+            if retry > 0:
+                logger.info("retry: {}".format(retry))
+            circuit_breaker.before_call()
+            start = time.time()
+            result = func(deployment) if pool is not None else func()
+            circuit_breaker.record_success()
+            if pool is not None:
+                pool.record_success(deployment, time.time() - start)
+            return result
+        except Exception as e:
+            logger.warning("An error occurred on {}: {}".format(endpoint, str(e)))
+            if not is_retryable(e):
+                raise e
+            if not isinstance(e, CircuitOpenError):
+                circuit_breaker.record_failure()
+                if pool is not None:
+                    pool.record_failure(deployment, get_retry_after(e))
+            retry += 1
+            if retry >= retry_count:
+                raise e
+            backoff = compute_backoff(retry, get_retry_after(e))
+        finally:
+            # 待っている間は、ほかのワーカーがdeploymentを使えるように枠を返す
+            if pool is not None:
+                pool.release(deployment)
+        time.sleep(backoff)
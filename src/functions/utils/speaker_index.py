@@ -0,0 +1,109 @@
+import json
+import os
+from typing import List, Union
+
+import numpy as np
+from filelock import FileLock
+
+from src.functions.config import SPEAKER_INDEX_DIR, SPEAKER_MATCH_THRESHOLD
+from src.functions.model import Speaker
+from src.log.my_logger import MyLogger
+
+my_logger = MyLogger(__name__)
+logger = my_logger.logger
+
+
+class SpeakerIndex:
+    """
+    既知の話者の特徴量を保存して、発話の特徴量から話者を引く
+    特徴量はembeddings.npy（正規化済みのN x D行列）、話者情報はspeakers.json（行ごと）に保存する
+    embeddings.npyはメモリマップで読み込むので、登録数が増えても読み込みは一瞬で済む
+    読み書きはindex.lockで排他するので、複数のプロセスから同時に登録しても失われない
+    """
+
+    def __init__(
+        self,
+        index_dir: Union[str, None] = None,
+        threshold: Union[float, None] = None,
+    ):
+        self._index_dir = index_dir or SPEAKER_INDEX_DIR
+        self._threshold = threshold or SPEAKER_MATCH_THRESHOLD
+        self._embeddings_file_path = os.path.join(self._index_dir, "embeddings.npy")
+        self._speakers_file_path = os.path.join(self._index_dir, "speakers.json")
+        os.makedirs(self._index_dir, exist_ok=True)
+        self._lock = FileLock(os.path.join(self._index_dir, "index.lock"))
+        self._embeddings: Union[np.ndarray, None] = None
+        self._speakers: List[Speaker] = []
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self._speakers)
+
+    def _load(self):
+        with self._lock:
+            self._load_unlocked()
+
+    def _load_unlocked(self):
+        self._embeddings = None
+        self._speakers = []
+        if not os.path.exists(self._embeddings_file_path):
+            return
+        embeddings = np.load(self._embeddings_file_path, mmap_mode="r")
+        speakers = []
+        if os.path.exists(self._speakers_file_path):
+            with open(self._speakers_file_path, "r", encoding="UTF-8") as f:
+                speakers = [Speaker(**s) for s in json.load(f)]
+        # embeddings.npyを置き換えたあと、speakers.jsonを置き換える前に止まった場合は、
+        # speakers.jsonにある分だけを使う
+        if len(embeddings) != len(speakers):
+            logger.warning(
+                f"speaker index is inconsistent: embeddings={len(embeddings)}, speakers={len(speakers)}"
+            )
+            n = min(len(embeddings), len(speakers))
+            embeddings, speakers = embeddings[:n], speakers[:n]
+        self._embeddings = embeddings
+        self._speakers = speakers
+
+    def add(self, speaker: Speaker, embeddings: Union[np.ndarray, list]):
+        """
+        話者の特徴量を登録する
+        1人の話者に複数の特徴量を登録してもよい（声の調子が違う会議など）
+        """
+        new_embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        norms = np.linalg.norm(new_embeddings, axis=1, keepdims=True)
+        new_embeddings = new_embeddings / np.maximum(norms, 1e-12)
+        with self._lock:
+            # ほかのプロセスが登録した分も含めるため、ロックを取ってから読み直す
+            self._load_unlocked()
+            if self._embeddings is not None:
+                new_embeddings = np.concatenate(
+                    [np.asarray(self._embeddings), new_embeddings]
+                )
+            speakers = self._speakers + [speaker] * (len(new_embeddings) - len(self))
+            # 一時ファイルに書いてから置き換える
+            # Windowsではメモリマップ中のファイルは置き換えられないので、先に解放する
+            self._embeddings = None
+            tmp_embeddings_file_path = self._embeddings_file_path + ".tmp.npy"
+            tmp_speakers_file_path = self._speakers_file_path + ".tmp"
+            np.save(tmp_embeddings_file_path, new_embeddings)
+            with open(tmp_speakers_file_path, "w", encoding="UTF-8") as f:
+                json.dump([s.model_dump() for s in speakers], f, ensure_ascii=False)
+            os.replace(tmp_embeddings_file_path, self._embeddings_file_path)
+            os.replace(tmp_speakers_file_path, self._speakers_file_path)
+            self._load_unlocked()
+
+    def query(self, features: Union[np.ndarray, list]) -> List[Union[Speaker, None]]:
+        """
+        発話ごとに、cosine類似度が最も高い既知の話者を返す
+        類似度がthresholdに届かない発話と、特徴量がnp.zeros(40)の発話はNoneにする
+        """
+        features = np.atleast_2d(np.asarray(features, dtype=np.float32))
+        if self._embeddings is None or len(self) == 0 or features.size == 0:
+            return [None] * len(features)
+        similarities = features @ np.asarray(self._embeddings).T
+        best = np.argmax(similarities, axis=1)
+        best_similarities = similarities[np.arange(len(features)), best]
+        return [
+            self._speakers[b] if s >= self._threshold else None
+            for b, s in zip(best, best_similarities)
+        ]
@@ -0,0 +1,85 @@
+import re
+from typing import List, Union
+
+from src.functions.config import TRANSCRIPT_COMPACTION_DEDUPE_MIN_CHARS
+from src.functions.model import CompactionStats, Transcription
+from src.functions.utils.utils_ import count_tokens
+
+# 意味を持たないつなぎ言葉
+# 「あの」「その」は連体詞としても使うので、伸ばしている場合か区切りが続く場合だけ除外する
+# 「まあ」は「まあまあ」などと区別するため、前後が区切りの場合（単独のつなぎ言葉）だけ除外する
+_FILLER_PATTERN = re.compile(
+    r"(えー+っ?と|ええっ?と|えっと|えー+|あー+|うー+ん|うーん|んー+|"
+    r"あのー+|そのー+|あの(?=[、,。\s])|(?<![^、,。\s])ま[あぁ](?=[、,。\s]|$)|"
+    r"なんか(?=[、,\s]))[、,]?\s*"
+)
+# 4文字以上の同じ語句が4回以上続く部分（雑音を文字起こししたときのループ）
+_REPEAT_PATTERN = re.compile(r"(.{4,30}?)(?:[、,。\s]*\1){3,}")
+# 数字と区切りだけの語句（「100、100、100円」など、繰り返し自体に意味がある）
+_NUMBER_PATTERN = re.compile(r"^[\d０-９,.、。\s]+$")
+# 句読点と空白だけの文字列
+_EMPTY_PATTERN = re.compile(r"^[、,。.!?！？\s]*$")
+
+
+def _collapse_repeat(match: re.Match) -> str:
+    unit = match.group(1)
+    if _NUMBER_PATTERN.match(unit):
+        return match.group(0)
+    return unit
+
+
+def compact_text(text: str) -> str:
+    """
+    つなぎ言葉を取り除き、同じ語句の繰り返しを1回にまとめる
+    """
+    text = _FILLER_PATTERN.sub("", text)
+    text = _REPEAT_PATTERN.sub(_collapse_repeat, text)
+    return text.strip()
+
+
+def compact_transcriptions(
+    transcriptions: List[Transcription],
+    dedupe_min_chars: Union[int, None] = None,
+) -> List[Transcription]:
+    """
+    要約の前に、文字起こしからトークンを減らす
+    - つなぎ言葉と、同じ語句の繰り返しを取り除く
+    - 何も残らない発話（無音や雑音）を除外する
+    - 同じsectionで直前と同じ発話が続く場合は除外する（whisperが雑音で繰り返し出力する文）
+      短い発話は相づちとして繰り返されることがあるので、dedupe_min_chars文字以上の場合だけ
+    """
+    dedupe_min_chars = dedupe_min_chars or TRANSCRIPT_COMPACTION_DEDUPE_MIN_CHARS
+    new_transcriptions: List[Transcription] = []
+    previous = None
+    for t in transcriptions:
+        text = compact_text(t.text)
+        if _EMPTY_PATTERN.match(text):
+            continue
+        if (
+            previous is not None
+            and previous.section == t.section
+            and previous.text == text
+            and len(text) >= dedupe_min_chars
+        ):
+            continue
+        previous = t.model_copy(update=dict(text=text))
+        new_transcriptions.append(previous)
+    return new_transcriptions
+
+
+def measure_compaction(
+    before: List[Transcription], after: List[Transcription]
+) -> CompactionStats:
+    """
+    compact_transcriptionsの前後の発話数・文字数・トークン数を返す
+    """
+    text_before = " ".join([t.text for t in before])
+    text_after = " ".join([t.text for t in after])
+    return CompactionStats(
+        segments_before=len(before),
+        segments_after=len(after),
+        chars_before=len(text_before),
+        chars_after=len(text_after),
+        tokens_before=count_tokens(text_before),
+        tokens_after=count_tokens(text_after),
+    )
@@ -0,0 +1,216 @@
+import json
+from typing import Dict, List, Sequence, Union
+
+import numpy as np
+
+from src.functions.model import Speaker, Transcription
+
+
+def _factorize(values: Sequence) -> tuple:
+    # 同じ値が多い列（話者、キーワード）は、ユニークな値の一覧と番号で持つ
+    uniques: list = []
+    index: dict = {}
+    codes = np.empty(len(values), dtype=np.int32)
+    for i, value in enumerate(values):
+        key = value if isinstance(value, str) else value.model_dump_json()
+        if key not in index:
+            index[key] = len(uniques)
+            uniques.append(value)
+        codes[i] = index[key]
+    return codes, uniques
+
+
+def group_indices_by_section(section: Union[np.ndarray, List[int]]) -> Dict[int, np.ndarray]:
+    """
+    sectionごとの行番号を返す（sectionの昇順、section内は元の順番）
+    """
+    section = np.asarray(section, dtype=np.int64)
+    order = np.argsort(section, kind="stable")
+    sections, first = np.unique(section[order], return_index=True)
+    groups = np.split(order, first[1:])
+    return {int(s): g for s, g in zip(sections, groups)}
+
+
+class TranscriptTable:
+    """
+    文字起こし結果を列ごとにまとめて持つ
+    Transcriptionのリストと相互に変換でき、時刻の補正やsectionごとの分割をまとめて計算する
+
+    - start, end, section: 発話数の長さのnumpy配列
+    - text: すべての発話をつないだ文字列と、発話ごとの開始位置（offsets）
+    - features: 発話数 x 次元の行列（特徴量のない発話は0で埋め、has_featuresで区別する）
+    - speaker, keywords: ユニークな値の一覧と、発話ごとの番号
+    """
+
+    def __init__(
+        self,
+        start: np.ndarray,
+        end: np.ndarray,
+        section: np.ndarray,
+        text_buffer: str,
+        text_offsets: np.ndarray,
+        features: np.ndarray,
+        has_features: np.ndarray,
+        speaker_codes: np.ndarray,
+        speakers: List[Speaker],
+        keyword_codes: np.ndarray,
+        keywords: List[str],
+    ):
+        self.start = start
+        self.end = end
+        self.section = section
+        self.text_buffer = text_buffer
+        self.text_offsets = text_offsets
+        self.features = features
+        self.has_features = has_features
+        self.speaker_codes = speaker_codes
+        self.speakers = speakers
+        self.keyword_codes = keyword_codes
+        self.keywords = keywords
+
+    def _replace(self, **kwargs) -> "TranscriptTable":
+        # 変更しない列は、コピーせずに共有する
+        columns = dict(vars(self))
+        columns.update(kwargs)
+        return TranscriptTable(**columns)
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    @classmethod
+    def from_transcriptions(cls, transcriptions: List[Transcription]) -> "TranscriptTable":
+        texts = [t.text for t in transcriptions]
+        text_offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        np.cumsum([len(text) for text in texts], out=text_offsets[1:])
+        dim = max([len(t.features) for t in transcriptions], default=0)
+        features = np.zeros((len(transcriptions), dim), dtype=np.float64)
+        has_features = np.zeros(len(transcriptions), dtype=bool)
+        for i, t in enumerate(transcriptions):
+            if len(t.features) > 0:
+                features[i, : len(t.features)] = t.features
+                has_features[i] = True
+        speaker_codes, speakers = _factorize([t.speaker for t in transcriptions])
+        keyword_codes, keywords = _factorize([t.keywords for t in transcriptions])
+        return cls(
+            start=np.array([t.start for t in transcriptions], dtype=np.float64),
+            end=np.array([t.end for t in transcriptions], dtype=np.float64),
+            section=np.array([t.section for t in transcriptions], dtype=np.int32),
+            text_buffer="".join(texts),
+            text_offsets=text_offsets,
+            features=features,
+            has_features=has_features,
+            speaker_codes=speaker_codes,
+            speakers=speakers,
+            keyword_codes=keyword_codes,
+            keywords=keywords,
+        )
+
+    def text(self, i: int) -> str:
+        return self.text_buffer[self.text_offsets[i] : self.text_offsets[i + 1]]
+
+    @property
+    def texts(self) -> List[str]:
+        return [self.text(i) for i in range(len(self))]
+
+    def to_transcriptions(self) -> List[Transcription]:
+        """
+        Transcriptionのリストに戻す
+        値は作成時に検証済みなので、model_constructで検証を省略する
+        """
+        start = self.start.tolist()
+        end = self.end.tolist()
+        section = self.section.tolist()
+        return [
+            Transcription.model_construct(
+                text=self.text(i),
+                keywords=self.keywords[self.keyword_codes[i]],
+                speaker=self.speakers[self.speaker_codes[i]],
+                features=self.features[i].tolist() if self.has_features[i] else [],
+                start=start[i],
+                end=end[i],
+                section=section[i],
+            )
+            for i in range(len(self))
+        ]
+
+    def take(self, indices: Union[np.ndarray, List[int]]) -> "TranscriptTable":
+        """
+        指定した行だけを持つ新しいTranscriptTableを返す
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = self.text_offsets[indices + 1] - self.text_offsets[indices]
+        text_offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=text_offsets[1:])
+        return self._replace(
+            start=self.start[indices],
+            end=self.end[indices],
+            section=self.section[indices],
+            text_buffer="".join([self.text(i) for i in indices]),
+            text_offsets=text_offsets,
+            features=self.features[indices],
+            has_features=self.has_features[indices],
+            speaker_codes=self.speaker_codes[indices],
+            keyword_codes=self.keyword_codes[indices],
+        )
+
+    def rebase(self, offset: Union[float, Dict[int, float]]) -> "TranscriptTable":
+        """
+        start, endにoffsetを足した新しいTranscriptTableを返す
+        offsetにdictを渡すと、sectionごとに異なるoffsetを足す
+        """
+        if isinstance(offset, dict):
+            sections = np.array(list(offset.keys()), dtype=np.int32)
+            values = np.array(list(offset.values()), dtype=np.float64)
+            order = np.argsort(sections)
+            positions = np.searchsorted(sections[order], self.section)
+            positions = np.minimum(positions, len(sections) - 1)
+            found = sections[order][positions] == self.section
+            offsets = np.where(found, values[order][positions], 0.0)
+        else:
+            offsets = np.full(len(self), offset, dtype=np.float64)
+        return self._replace(start=self.start + offsets, end=self.end + offsets)
+
+    def group_by_section(self) -> Dict[int, "TranscriptTable"]:
+        return {
+            section: self.take(indices)
+            for section, indices in group_indices_by_section(self.section).items()
+        }
+
+    def save(self, file_path: str):
+        """
+        npz形式で保存する
+        """
+        with open(file_path, "wb") as f:
+            np.savez(
+                f,
+                start=self.start,
+                end=self.end,
+                section=self.section,
+                text_buffer=np.array(self.text_buffer),
+                text_offsets=self.text_offsets,
+                features=self.features,
+                has_features=self.has_features,
+                speaker_codes=self.speaker_codes,
+                speakers=np.array(
+                    json.dumps([s.model_dump() for s in self.speakers], ensure_ascii=False)
+                ),
+                keyword_codes=self.keyword_codes,
+                keywords=np.array(json.dumps(self.keywords, ensure_ascii=False)),
+            )
+
+    @classmethod
+    def load(cls, file_path: str) -> "TranscriptTable":
+        with np.load(file_path) as data:
+            return cls(
+                start=data["start"],
+                end=data["end"],
+                section=data["section"],
+                text_buffer=str(data["text_buffer"]),
+                text_offsets=data["text_offsets"],
+                features=data["features"],
+                has_features=data["has_features"],
+                speaker_codes=data["speaker_codes"],
+                speakers=[Speaker(**s) for s in json.loads(str(data["speakers"]))],
+                keyword_codes=data["keyword_codes"],
+                keywords=json.loads(str(data["keywords"])),
+            )
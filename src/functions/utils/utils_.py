@@ -1,31 +1,54 @@
 import asyncio
 import os
-import tempfile
-import time
-from typing import Dict, List, Union
+from typing import Callable, Dict, List, Union
 
+import httpx
 import librosa
 import numpy as np
 import openai
 import requests
-from pydub import AudioSegment
-from scipy.stats import multivariate_normal
+from scipy.special import logsumexp
 from sklearn.cluster import KMeans
 
 from src.functions.config import (
     DEFAULT_LANGUAGE,
+    FEATURE_HOP_LENGTH,
+    FEATURE_SAMPLE_RATE,
     IGNORE_DURATION_MILISECONDS,
+    N_MFCC,
     OPENAI_API_35_ENDPOINT,
     OPENAI_API_35_MODEL,
     OPENAI_API_35_VERSION,
+    OPENAI_API_WHISPER_CONNECT_TIMEOUT,
     OPENAI_API_WHISPER_DEPLOYMENT,
-    OPENAI_API_WHISPER_ENDPOINT,
+    OPENAI_API_WHISPER_DEPLOYMENTS,
+    OPENAI_API_WHISPER_TIMEOUT,
     OPENAI_API_WHISPER_VERSION,
+    OPENAI_CHAT_DEPLOYMENTS,
     OPENAI_CHAT_TEMPERATURE,
+    OPENAI_CHAT_STREAM_TIMEOUT,
+    OPENAI_CHAT_TOKEN_MARGIN,
+    OPENAI_CHAT_USE_STREAM,
     OPENAI_USE_AZURE,
     RETRY_COUNT,
+    SPEAKER_CANDIDATES,
+    TOKENIZER_PATH,
     USE_FASTER_WHISPER,
 )
+from src.functions.utils.deployment_pool import DeploymentPool
+from src.functions.utils.resilience import TransientError, call_with_retry
+from src.log.my_logger import MyLogger
+
+my_logger = MyLogger(__name__)
+logger = my_logger.logger
+
+# tokenizerは最初に使うときにTOKENIZER_PATHから読み込む
+# ファイルがない場合や読み込みに失敗した場合はFalseにして、以降は文字数で代用する
+_tokenizer = None
+
+# リクエストの回数のうち、出力がmax_tokensで切れて続きをリクエストした回数（truncations）と、
+# リトライ時に途中までの出力から再開した回数（resumes）を分けて数え、ログに出す（プロセスごと）
+_chat_completion_stats = {"requests": 0, "truncations": 0, "resumes": 0}
 
 
 def set_path_for_ffmpeg_bin(base_dir: str):
@@ -34,6 +57,108 @@ def set_path_for_ffmpeg_bin(base_dir: str):
     os.environ["PATH"] = ffmpeg_path + os.pathsep + os.environ["PATH"]
 
 
+def count_tokens(text: str) -> int:
+    """
+    文章のトークン数を数える
+    tokenizerが使えない場合は、文字数で代用する
+    文字数はおおよその見積もりで、漢字の多い文章では実際のトークン数より少なくなることがある
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        # Hubからのダウンロードは、オフラインだとリトライで長く待たされるので行わない
+        if not os.path.exists(TOKENIZER_PATH):
+            logger.warning(
+                f"tokenizer is not found at {TOKENIZER_PATH}. count characters instead"
+            )
+            _tokenizer = False
+        else:
+            try:
+                from tokenizers import Tokenizer
+
+                _tokenizer = Tokenizer.from_file(TOKENIZER_PATH)
+            except Exception as e:
+                logger.warning(f"failed to load tokenizer: {e}. count characters instead")
+                _tokenizer = False
+    if not _tokenizer:
+        return len(text)
+    return len(_tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+def split_text_by_tokens(
+    texts: List[str],
+    max_tokens: int,
+    separator: str = " ",
+    split_long_text: bool = True,
+) -> List[str]:
+    """
+    textsを順番を保ったまま、max_tokensを超えないように詰めて結合する
+    1つでmax_tokensを超えるtextは、文字数で等分してから詰める
+    split_long_textがFalseの場合は分けずに、そのtextだけで1つにする
+    """
+    chunks: List[str] = []
+    chunk: List[str] = []
+    chunk_tokens = 0
+    for text in texts:
+        n_tokens = count_tokens(text)
+        if split_long_text and n_tokens > max_tokens:
+            n_parts = -(-n_tokens // max_tokens)
+            part_len = -(-len(text) // n_parts)
+            parts = [text[i : i + part_len] for i in range(0, len(text), part_len)]
+        else:
+            parts = [text]
+        for part in parts:
+            n_tokens = count_tokens(part) if len(parts) > 1 else n_tokens
+            if chunk and chunk_tokens + n_tokens > max_tokens:
+                chunks.append(separator.join(chunk))
+                chunk = []
+                chunk_tokens = 0
+            chunk.append(part)
+            chunk_tokens += n_tokens
+    if chunk:
+        chunks.append(separator.join(chunk))
+    return chunks
+
+
+def count_message_tokens(messages: List[Dict[str, str]]) -> int:
+    # メッセージごとに役割や区切りの分として4トークン程度が追加される
+    return sum([count_tokens(m["content"] or "") + 4 for m in messages]) + 3
+
+
+def route_chat_deployment(
+    messages: List[Dict[str, str]],
+    expected_output_tokens: Union[int, None] = None,
+    openai_api_model: Union[str, None] = None,
+) -> Dict:
+    """
+    入力と出力のトークン数を見積もって、1回のリクエストで収まるdeploymentとmax_tokensを決める
+    openai_api_modelが指定されている場合は、そのモデルのmax_tokensだけを決める
+    expected_output_tokensがない場合は、最後のメッセージと同じくらいの出力を見込む
+    tokenizerがなく文字数で見積もった場合は、実際のトークン数より少ないことがあり、
+    max_tokensを指定するとcontext_lengthを超えてエラーになるので、max_tokensは指定しない
+    """
+    input_tokens = count_message_tokens(messages)
+    if expected_output_tokens is None:
+        expected_output_tokens = count_tokens(messages[-1]["content"] or "")
+    deployments = OPENAI_CHAT_DEPLOYMENTS
+    if openai_api_model:
+        deployments = [d for d in deployments if d["model"] == openai_api_model]
+        if not deployments:
+            return dict(max_tokens=None)
+    required_tokens = input_tokens + expected_output_tokens + OPENAI_CHAT_TOKEN_MARGIN
+    # 収まるdeploymentがない場合は、一番大きいものを使う
+    deployment = next(
+        (d for d in deployments if required_tokens <= d["context_length"]),
+        max(deployments, key=lambda d: d["context_length"]),
+    )
+    max_tokens = deployment["context_length"] - input_tokens - OPENAI_CHAT_TOKEN_MARGIN
+    return dict(
+        openai_api_endpoint=deployment["endpoint"],
+        openai_api_version=deployment["version"],
+        openai_api_model=deployment["model"],
+        max_tokens=max_tokens if _tokenizer and max_tokens > 0 else None,
+    )
+
+
 def create_chat_completion(
     messages: List[Dict[str, str]],
     max_tokens: Union[int, None] = None,
@@ -43,34 +168,62 @@ def create_chat_completion(
     openai_api_version: Union[str, None] = None,
     openai_api_model: Union[str, None] = None,
     retry_count: Union[int, None] = None,
+    expected_output_tokens: Union[int, None] = None,
+    stream: Union[bool, None] = None,
 ) -> Union[str, None]:
+    # モデルが指定されていない場合は、トークン数からdeploymentを選ぶ
+    # 指定されている場合も、出力が切れないようにmax_tokensを決める
+    route = route_chat_deployment(messages, expected_output_tokens, openai_api_model)
+    if not openai_api_model:
+        openai_api_model = route["openai_api_model"]
+    max_tokens = max_tokens or route["max_tokens"]
     openai_use_azure = openai_use_azure or OPENAI_USE_AZURE
-    openai_api_endpoint = openai_api_endpoint or OPENAI_API_35_ENDPOINT  # GPT3.5を使う
-    openai_api_version = openai_api_version or OPENAI_API_35_VERSION  # GPT3.5を使う
     openai_api_model = openai_api_model or OPENAI_API_35_MODEL  # GPT3.5を使う
     temperature = temperature or OPENAI_CHAT_TEMPERATURE
     retry_count = retry_count or RETRY_COUNT
+    stream = OPENAI_CHAT_USE_STREAM if stream is None else stream
 
-    retry = 0
-    while retry < retry_count:
-        try:
-            if retry > 0:
-                print("retry: {}".format(retry))
-            return _create_chat_completion(
+    # 同じモデルのdeploymentの中から、リクエストごとに振り分ける
+    # endpointが指定されている場合は、そのendpointに固定する
+    deployments = [
+        d
+        for d in OPENAI_CHAT_DEPLOYMENTS
+        if d["model"] == openai_api_model
+        and (not openai_api_endpoint or d["endpoint"] == openai_api_endpoint)
+    ]
+    if not deployments:
+        deployments = [
+            dict(
+                endpoint=openai_api_endpoint or OPENAI_API_35_ENDPOINT,
+                version=openai_api_version or OPENAI_API_35_VERSION,
+                model=openai_api_model,
+            )
+        ]
+    pool = DeploymentPool(f"chat|{openai_api_model}", deployments)
+
+    # 途中まで受け取った出力は、リトライ時に続きから生成するために残しておく
+    checkpoint: List[str] = []
+    try:
+        return call_with_retry(
+            lambda deployment: _create_chat_completion(
                 messages,
                 max_tokens,
                 temperature,
                 openai_use_azure,
-                openai_api_endpoint,
-                openai_api_version,
+                deployment["endpoint"],
+                openai_api_version or deployment["version"],
                 openai_api_model,
-            )
-        except Exception as e:
-            print("An error occurred:", str(e))
-            retry += 1
-            time.sleep(5 * retry)
-            continue
-    return None
+                stream,
+                checkpoint,
+                api_key_env=deployment.get("api_key_env"),
+                on_headers=lambda headers: pool.record_headers(deployment, headers),
+            ),
+            retry_count=retry_count,
+            pool=pool,
+        )
+    except Exception as e:
+        print("An error occurred:", str(e))
+        return None
 
 
 def _create_chat_completion(
@@ -81,47 +234,129 @@ def _create_chat_completion(
     openai_api_endpoint: str,
     openai_api_version: str,
     openai_api_model: str,
+    stream: bool = False,
+    checkpoint: Union[List[str], None] = None,
+    api_key_env: Union[str, None] = None,
+    on_headers: Union[Callable, None] = None,
 ) -> str:
-    openai.api_type = "azure" if openai_use_azure else "openai"
-
-    # azureの場合
-    openai.api_version = openai_api_version
-    openai.azure_endpoint = openai_api_endpoint
-    if "gpt-4" in openai_api_model:
-        openai.api_key = os.environ["OPENAI_API_KEY"]
+    """
+    checkpointには受け取った出力が順に追記される
+    リトライ時に同じcheckpointを渡すと、途中まで受け取った出力の続きから生成する
+    on_headersには、レスポンスヘッダーが渡される
+    """
+    if api_key_env:
+        api_key = os.environ[api_key_env]
+    elif "gpt-4" in openai_api_model:
+        api_key = os.environ["OPENAI_API_KEY"]
     else:
-        openai.api_key = os.environ["OPENAI_API_35_KEY"]
+        api_key = os.environ["OPENAI_API_35_KEY"]
     os.environ["http_proxy"] = "http://egvs00395:3128"
     os.environ["https_proxy"] = "http://egvs00395:3128"
-    need_continue: bool = False
-    contents: List[str] = []
-    response = openai.chat.completions.create(
+    # スレッドから同時に呼ばれるので、openaiモジュールのグローバル設定は使わずに
+    # 呼び出しごとにclientを作る
+    if openai_use_azure:
+        # azureの場合
+        client = openai.AzureOpenAI(
+            api_key=api_key,
+            api_version=openai_api_version,
+            azure_endpoint=openai_api_endpoint,
+            max_retries=0,
+        )
+    else:
+        client = openai.OpenAI(api_key=api_key, max_retries=0)
+    contents: List[str] = checkpoint if checkpoint is not None else []
+    if contents:
+        _chat_completion_stats["resumes"] += 1
+        logger.info(
+            "resume from partial output after retry. resumes: {}/{}".format(
+                _chat_completion_stats["resumes"],
+                _chat_completion_stats["requests"],
+            )
+        )
+    need_continue: bool = True
+    while need_continue:
+        request_messages = messages
+        if contents:
+            # 途中までの出力がある場合は、その続きを生成させる
+            # max_tokensは元の入力に合わせて決めているので、指定しない
+            message = {
+                "role": "assistant",
+                "content": "".join(contents),
+            }
+            request_messages = messages + [message]
+        _chat_completion_stats["requests"] += 1
+        if stream:
+            finish_reason = _create_chat_completion_stream(
+                client,
+                request_messages,
+                None if contents else max_tokens,
+                temperature,
+                openai_api_model,
+                contents,
+                on_headers,
+            )
+        else:
+            raw_response = client.chat.completions.with_raw_response.create(
+                model=openai_api_model,
+                messages=request_messages,
+                max_tokens=None if contents else max_tokens,
+                temperature=temperature,
+                timeout=60,
+            )
+            if on_headers is not None:
+                on_headers(raw_response.headers)
+            response = raw_response.parse()
+            contents.append(response.choices[0].message.content or "")
+            finish_reason = response.choices[0].finish_reason
+        if finish_reason != "length":
+            need_continue = False
+        else:
+            _chat_completion_stats["truncations"] += 1
+            logger.info(
+                "output was truncated. request continuation. truncations: {}/{}".format(
+                    _chat_completion_stats["truncations"],
+                    _chat_completion_stats["requests"],
+                )
+            )
+    return "".join(contents)
+
+
+def _create_chat_completion_stream(
+    client: openai.OpenAI,
+    messages: List[Dict[str, str]],
+    max_tokens: Union[int, None],
+    temperature: float,
+    openai_api_model: str,
+    contents: List[str],
+    on_headers: Union[Callable, None] = None,
+) -> Union[str, None]:
+    """
+    ストリーミングで出力を受け取り、届いた分からcontentsに追記する
+    タイムアウトは全体の時間ではなく、トークンが届く間隔で判定する
+    """
+    response = client.chat.completions.create(
         model=openai_api_model,
         messages=messages,
         max_tokens=max_tokens,
         temperature=temperature,
-        timeout=60,
+        stream=True,
+        # readのタイムアウトがトークン間の待ち時間の上限になる
+        timeout=httpx.Timeout(OPENAI_CHAT_STREAM_TIMEOUT, connect=10.0),
     )
-    content = response.choices[0].message.content
-    contents.append(content)
-    if response.choices[0].finish_reason == "length":
-        need_continue = True
-    while need_continue:
-        message = {
-            "role": "assistant",
-            "content": content,
-        }
-        response = openai.chat.completions.create(
-            model=openai_api_model,
-            messages=messages + [message],
-            temperature=temperature,
-            timeout=60,
-        )
-        content = response.choices[0].message.content
-        contents.append(content)
-        if response.choices[0].finish_reason != "length":
-            need_continue = False
-    return "".join(contents)
+    if on_headers is not None:
+        on_headers(response.response.headers)
+    finish_reason = None
+    for chunk in response:
+        # azureの場合、content filterの結果だけでchoicesが空のchunkが届く
+        if not chunk.choices:
+            continue
+        if chunk.choices[0].delta.content:
+            contents.append(chunk.choices[0].delta.content)
+        if chunk.choices[0].finish_reason:
+            finish_reason = chunk.choices[0].finish_reason
+    if finish_reason is None:
+        raise TransientError("stream ended without finish_reason")
+    return finish_reason
 
 
 def transcript_by_whisper(
@@ -136,16 +371,20 @@ def transcript_by_whisper(
 ) -> Union[str, None]:
     language = language or DEFAULT_LANGUAGE
     use_faster_whisper = use_faster_whisper or USE_FASTER_WHISPER
-    openai_api_whisper_endpoint = (
-        openai_api_whisper_endpoint or OPENAI_API_WHISPER_ENDPOINT
-    )
-    openai_api_whisper_deployment = (
-        openai_api_whisper_deployment or OPENAI_API_WHISPER_DEPLOYMENT
-    )
-    openai_api_whisper_api_version = (
-        openai_api_whisper_api_version or OPENAI_API_WHISPER_VERSION
-    )
     retry_count = retry_count or RETRY_COUNT
+    # endpointが指定されている場合は、そのendpointに固定する
+    # 指定されていない場合は、deploymentの一覧からリクエストごとに振り分ける
+    deployments = OPENAI_API_WHISPER_DEPLOYMENTS
+    if openai_api_whisper_endpoint:
+        deployments = [
+            dict(
+                endpoint=openai_api_whisper_endpoint,
+                deployment=openai_api_whisper_deployment
+                or OPENAI_API_WHISPER_DEPLOYMENT,
+                version=openai_api_whisper_api_version or OPENAI_API_WHISPER_VERSION,
+            )
+        ]
+    pool = DeploymentPool("whisper", deployments)
 
     if use_faster_whisper:
         return _transcript_by_faster_whisper(
@@ -154,25 +393,24 @@ def transcript_by_whisper(
             language,
         )
     else:
-        retry = 0
-        while retry < retry_count:
-            try:
-                if retry > 0:
-                    print("retry: {}".format(retry))
-                return _transcript_by_azure_whisper(
+        try:
+            return call_with_retry(
+                lambda deployment: _transcript_by_azure_whisper(
                     file_path,
                     prompt,
                     language,
-                    openai_api_whisper_endpoint,
-                    openai_api_whisper_deployment,
-                    openai_api_whisper_api_version,
-                )
-            except Exception as e:
-                print("An error occurred on whisper:", str(e))
-                retry += 1
-                time.sleep(5 * retry)
-                continue
-    return None
+                    deployment["endpoint"],
+                    deployment["deployment"],
+                    deployment["version"],
+                    api_key_env=deployment.get("api_key_env"),
+                    on_headers=lambda headers: pool.record_headers(deployment, headers),
+                ),
+                retry_count=retry_count,
+                pool=pool,
+            )
+        except Exception as e:
+            print("An error occurred on whisper:", str(e))
+            return None
 
 
 def _transcript_by_azure_whisper(
@@ -182,6 +420,8 @@ def _transcript_by_azure_whisper(
     openai_api_whisper_endpoint: str,
     openai_api_whisper_deployment: str,
     openai_api_whisper_api_version: str,
+    api_key_env: Union[str, None] = None,
+    on_headers: Union[Callable, None] = None,
 ) -> Union[list, None]:
     # azureの場合
     # url = "https://ek53-azureopenai-ncus.openai.azure.com/openai/deployments/whisper-1/audio/transcriptions?api-version=2023-09-01-preview"
@@ -192,23 +432,30 @@ def _transcript_by_azure_whisper(
     )
     headers = {
         "content_type": "multipart/form-data",  # "multipart/form-data; boundary=----WebKitFormBoundary7MA4YWxkTrZu0gW",
-        "api-key": os.getenv("OPENAI_API_WHISPER_KEY"),
+        "api-key": os.getenv(api_key_env or "OPENAI_API_WHISPER_KEY"),
     }
     # data = {"prompt": prompt, "response_format": "verbose_json"}
     data = {"prompt": prompt, "language": language, "response_format": "verbose_json"}
-    try:
-        with open(file_path, "rb") as f:
-            transcript = requests.post(
-                url, headers=headers, data=data, files=[("file", f)]
-            ).json()
-        # 0.3秒以下の音声は無視する
-        return [
-            {"start": s["start"], "end": s["end"], "text": s["text"]}
-            for s in transcript.get("segments")
-            if float(s["end"]) - float(s["start"]) > IGNORE_DURATION_MILISECONDS / 1000
-        ]
-    except:
-        return None
+    # エラーはリトライするかどうかを判定するために、呼び出し元に送出する
+    # 応答がないまま待ち続けないように、タイムアウトを設定する（タイムアウトはリトライする）
+    with open(file_path, "rb") as f:
+        response = requests.post(
+            url,
+            headers=headers,
+            data=data,
+            files=[("file", f)],
+            timeout=(OPENAI_API_WHISPER_CONNECT_TIMEOUT, OPENAI_API_WHISPER_TIMEOUT),
+        )
+    if on_headers is not None:
+        on_headers(response.headers)
+    response.raise_for_status()
+    transcript = response.json()
+    # 0.3秒以下の音声は無視する
+    return [
+        {"start": s["start"], "end": s["end"], "text": s["text"]}
+        for s in transcript.get("segments")
+        if float(s["end"]) - float(s["start"]) > IGNORE_DURATION_MILISECONDS / 1000
+    ]
 
 
 def _transcript_by_faster_whisper(
@@ -244,76 +491,137 @@ def _transcript_by_faster_whisper(
 def get_features_of_voice(
     file_path: str, start_and_ends: List[List[float]]
 ) -> list[np.ndarray]:
-    # 音声ファイルから特徴量を抽出する
-    # file_pathから音声ファイルを取得して、transcript_listのstartとendの間の音声を抽出する
-    # 抽出した音声を一時ファイルに保存する
-    # 抽出した音声から特徴量を抽出する
-    format = file_path.split(".")[-1]
-    sound = AudioSegment.from_file(file_path, format=format)
-    features = []
-    with tempfile.TemporaryDirectory() as dname:
-        for start_and_end in start_and_ends:
-            # librosa.feature.mfccで特徴量を抽出する
-            # 失敗した場合は、np.zeros(40)を返す
-            # TODO: タイムアウトエラーの実装
-            try:
-                start = min(start_and_end)
-                end = max(start_and_end)
-                audio_segment = sound[start * 1000 : end * 1000]
-                fpath = os.path.join(dname, "tmp.mp3")
-                audio_segment.export(fpath, format="mp3")
-                mp3, sr = librosa.load(fpath, sr=None)
-                mfcc = librosa.feature.mfcc(y=mp3, sr=sr, n_mfcc=40)
-                mean_mfcc = np.mean(mfcc, axis=1)
-                norm_array = mean_mfcc / np.linalg.norm(mean_mfcc)
-            except:
-                norm_array = np.zeros(40)
-            features.append(norm_array.tolist())
-    return features
-
-
-def get_n_cluster_by_x_means(features: np.ndarray, n_clusters: list[int]) -> int:
+    # 音声ファイルから発話ごとの特徴量を抽出する
+    # 音声ファイルは一度だけデコードして、全体のMFCCを計算する
+    # 発話ごとの特徴量は、startとendの間のフレームのMFCCの平均を正規化したもの
+    # 区間が空の場合や失敗した場合は、np.zeros(40)を返す
+    features = np.zeros((len(start_and_ends), N_MFCC))
+    if len(start_and_ends) == 0:
+        return features.tolist()
+    try:
+        y, sr = librosa.load(file_path, sr=FEATURE_SAMPLE_RATE)
+        mfcc = librosa.feature.mfcc(
+            y=y, sr=sr, n_mfcc=N_MFCC, hop_length=FEATURE_HOP_LENGTH
+        )
+    except:
+        return features.tolist()
+    n_frames = mfcc.shape[1]
+    times = np.array([[min(s), max(s)] for s in start_and_ends], dtype=float)
+    frames = librosa.time_to_frames(times, sr=sr, hop_length=FEATURE_HOP_LENGTH)
+    starts = np.clip(frames[:, 0], 0, n_frames)
+    ends = np.clip(frames[:, 1], 0, n_frames)
+    # 累積和の差で、区間ごとの合計をまとめて計算する
+    cumsum = np.concatenate([np.zeros((N_MFCC, 1)), np.cumsum(mfcc, axis=1)], axis=1)
+    counts = ends - starts
+    sums = (cumsum[:, ends] - cumsum[:, starts]).T
+    means = sums / np.maximum(counts, 1)[:, np.newaxis]
+    norms = np.linalg.norm(means, axis=1)
+    valid = (counts > 0) & (norms > 0)
+    features[valid] = means[valid] / norms[valid][:, np.newaxis]
+    return features.tolist()
+
+
+def get_n_cluster_by_x_means(
+    features: np.ndarray, n_clusters: Union[list[int], None] = None
+) -> int:
     # 特徴量からクラスタリングを行う
     # 先にnp.zeros(40)を除外する
+    features = np.asarray(features, dtype=float)
     features = features[~np.all(features == 0, axis=1)]
+    if len(features) < 2:
+        return 1
 
     # そもそも特徴量のcosine類似度が高い場合は、クラスタリングを行わない
     # その場合は、n_clusters=1を返す
     # 基準となる特徴量を取得
     base_feature = features[0]
-    for i, f in enumerate(features):
-        if np.dot(base_feature, f) < 0.98:
-            break
-        if i == len(features) - 1:
-            return 1
-
-    # クラスタリングとBICの計算
-    bic_dict = {}
+    if np.all(features @ base_feature >= 0.98):
+        return 1
+
+    # クラスタ数の候補を小さい順に試し、k-meansは1回（n_init=1）だけ行う
+    # 2つ目以降の候補は、前の候補の結果から、ばらつきの大きいクラスタを分割した重心で始める
+    n_clusters = sorted(
+        set([n for n in (n_clusters or SPEAKER_CANDIDATES) if 1 <= n < len(features)])
+    )
+    if not n_clusters:
+        return 1
+    bic_dict: Dict[int, float] = {}
+    km: Union[KMeans, None] = None
     for n_cluster in n_clusters:
-        bic = 0
-        km = KMeans(n_clusters=n_cluster, init="k-means++", n_init=10, random_state=0)
+        if km is None:
+            init = "k-means++"
+        else:
+            init = _split_clusters(
+                features,
+                km.labels_,
+                km.cluster_centers_,
+                n_cluster - len(km.cluster_centers_),
+            )
+        km = KMeans(n_clusters=n_cluster, init=init, n_init=1, random_state=0)
         km.fit(features)
-        centers = km.cluster_centers_
-        for vec in features:
-            p_sum = 0
-            for i in range(n_cluster):
-                center = centers[i]
-                cov = np.cov(features[km.labels_ == i].T)
-                p_sum += multivariate_normal.pdf(
-                    vec, mean=center, cov=cov, allow_singular=True
-                )
-            bic -= np.log((p_sum + 1e-8) / n_cluster)
-        bic += n_cluster * features.shape[1] * np.log(features.shape[0]) / 2
-        bic_dict[n_cluster] = bic
+        bic_dict[n_cluster] = _compute_bic(features, km.labels_, km.cluster_centers_)
 
     # BICが最小のクラスタ数を取得
     n_cluster = min(bic_dict, key=bic_dict.get)
     return n_cluster
 
 
+def _split_clusters(
+    features: np.ndarray, labels: np.ndarray, centers: np.ndarray, n: int
+) -> np.ndarray:
+    """
+    二乗誤差の合計が最大のクラスタを、第1主成分の方向に2つに分ける操作をn回行い、重心を返す
+    """
+    labels = labels.copy()
+    centers = [c for c in centers]
+    for _ in range(n):
+        sse = [((features[labels == i] - c) ** 2).sum() for i, c in enumerate(centers)]
+        i = int(np.argmax(sse))
+        members_index = np.where(labels == i)[0]
+        if len(members_index) < 2:
+            # 分割できるクラスタがない場合は、最も遠い特徴量を重心に加える
+            distances = ((features[:, np.newaxis] - np.array(centers)) ** 2).sum(axis=2)
+            centers.append(features[np.argmax(distances.min(axis=1))])
+            continue
+        deviations = features[members_index] - centers[i]
+        _, s, vt = np.linalg.svd(deviations, full_matrices=False)
+        step = vt[0] * s[0] / np.sqrt(len(members_index))
+        center = centers[i]
+        centers[i] = center + step
+        centers.append(center - step)
+        labels[members_index[deviations @ vt[0] < 0]] = len(centers) - 1
+    return np.array(centers)
+
+
+def _compute_bic(features: np.ndarray, labels: np.ndarray, centers: np.ndarray) -> float:
+    """
+    k-meansの結果を、クラスタごとに対角共分散の正規分布を持つ混合分布とみなしてBICを計算する
+    パラメータ数は、平均と分散（クラスタ数 x 次元数 x 2）と混合比（クラスタ数 - 1）
+    要素数が少ないクラスタで分散が0に近づいて尤度が発散しないように、分散には下限を設ける
+    """
+    n_samples, n_features = features.shape
+    n_cluster = len(centers)
+    min_var = features.var(axis=0) * 1e-2 + 1e-12
+    log_pdfs = np.empty((n_samples, n_cluster))
+    for i in range(n_cluster):
+        members = features[labels == i]
+        var = members.var(axis=0) if len(members) > 1 else np.zeros(n_features)
+        var = np.maximum(var, min_var)
+        log_pdfs[:, i] = (
+            np.log(max(len(members), 1) / n_samples)
+            - 0.5 * np.sum(np.log(2 * np.pi * var))
+            - 0.5 * np.sum((features - centers[i]) ** 2 / var, axis=1)
+        )
+    log_likelihood = np.sum(logsumexp(log_pdfs, axis=1))
+    n_params = 2 * n_cluster * n_features + n_cluster - 1
+    bic = -log_likelihood + n_params * np.log(n_samples) / 2
+    return float(bic)
+
+
 def get_speakers_by_k_means(features: np.ndarray, n_clusters: int) -> List[str]:
     # 特徴量からクラスタリングを行う
     # クラスタリング時は、np.zeros(40)を除外
+    features = np.asarray(features, dtype=float)
     ex_features = features[~np.all(features == 0, axis=1)]
     km = KMeans(n_clusters=n_clusters, init="k-means++", n_init=10, random_state=0)
     km.fit(ex_features)
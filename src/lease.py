@@ -0,0 +1,276 @@
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+from typing import Dict, List, Set, Union
+
+from src.config import LEASE_HEARTBEAT_SECONDS, LEASE_TTL_SECONDS
+from src.log.my_logger import MyLogger
+
+my_logger = MyLogger(__name__)
+logger = my_logger.logger
+
+
+class LeaseManager:
+    """
+    複数のマシンで同じroot_dirを監視するときに、メディアファイルを処理するマシンを1台に決める
+
+    - root_dir/lease/<hash>.leaseを排他的に作成できたマシンが処理する（lease）
+    - 処理中はハートビートとしてleaseファイルの更新時刻を更新し続ける
+    - 処理が終わったら<hash>.doneを作成し、以降はどのマシンも処理しない
+      doneにはメディアファイルの大きさと更新時刻を記録し、同じ名前で別のファイルが置かれた場合は処理する
+    - 更新が途絶えたleaseは期限切れとして、別のマシンが引き継ぐ
+      引き継ぐときは<hash>.takeoverを排他的に作成し、期限切れと判断したleaseから
+      持ち主と更新時刻が変わっていないことを確かめてから消す
+    - 処理が終わったleaseも、同じくtakeoverを作成して、自分が持ち主のままであることを確かめてから消す
+
+    マシンごとに共有フォルダのマウント先が違ってもよいように、メディアはroot_dirからの相対パスで扱う
+    """
+
+    def __init__(self, root_dir: str, node_id: Union[str, None] = None):
+        self._root_dir = root_dir
+        self._lease_dir = os.path.join(root_dir, "lease")
+        os.makedirs(self._lease_dir, exist_ok=True)
+        self._node_id = node_id or f"{socket.gethostname()}-{os.getpid()}"
+        self._held: Set[str] = set()
+        # leaseを取ったときのメディアファイルの大きさと更新時刻（doneに記録する）
+        self._media_stats: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def _relpath(self, media_file_path: str) -> str:
+        return os.path.relpath(media_file_path, self._root_dir).replace(os.sep, "/")
+
+    def _paths(self, relpath: str) -> tuple:
+        name = hashlib.md5(relpath.encode()).hexdigest()
+        return (
+            os.path.join(self._lease_dir, f"{name}.lease"),
+            os.path.join(self._lease_dir, f"{name}.done"),
+        )
+
+    def _takeover_path(self, relpath: str) -> str:
+        name = hashlib.md5(relpath.encode()).hexdigest()
+        return os.path.join(self._lease_dir, f"{name}.takeover")
+
+    def _media_stat(self, relpath: str) -> Union[dict, None]:
+        try:
+            stat = os.stat(os.path.join(self._root_dir, *relpath.split("/")))
+        except OSError:
+            return None
+        # マシンによって更新時刻の精度が違うので、秒単位で比べる
+        return dict(size=stat.st_size, mtime=int(stat.st_mtime))
+
+    def _is_done(self, relpath: str) -> bool:
+        _, done_file_path = self._paths(relpath)
+        if not os.path.exists(done_file_path):
+            return False
+        done = self._read(done_file_path)
+        media_stat = self._media_stat(relpath)
+        # 大きさと更新時刻を記録していないdoneや、メディアファイルがない場合は処理済みとみなす
+        if done is None or "size" not in done or media_stat is None:
+            return True
+        return done["size"] == media_stat["size"] and done["mtime"] == media_stat["mtime"]
+
+    @staticmethod
+    def _read(lease_file_path: str) -> Union[dict, None]:
+        # 作成直後で中身が書き込まれていない場合などはNoneを返す
+        try:
+            with open(lease_file_path, "r", encoding="UTF-8") as f:
+                return json.load(f)
+        except Exception:
+            return None
+
+    @staticmethod
+    def _is_expired(lease_file_path: str) -> bool:
+        try:
+            return time.time() - os.path.getmtime(lease_file_path) > LEASE_TTL_SECONDS
+        except FileNotFoundError:
+            return False
+
+    @classmethod
+    def _owner(cls, lease_file_path: str) -> Union[tuple, None]:
+        # leaseの持ち主と更新時刻（引き継ぐ前に、変わっていないことを確かめるため）
+        try:
+            mtime = os.path.getmtime(lease_file_path)
+        except FileNotFoundError:
+            return None
+        lease = cls._read(lease_file_path)
+        return (lease["node_id"] if lease else None, mtime)
+
+    def _lock_takeover(self, relpath: str, timeout: float = 0.0) -> bool:
+        """
+        takeoverファイルを排他的に作成できた場合はTrueを返す
+        作成したマシンが止まって残ったtakeoverファイルは、期限切れなら消す
+        """
+        takeover_file_path = self._takeover_path(relpath)
+        deadline = time.time() + timeout
+        while True:
+            try:
+                os.close(os.open(takeover_file_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except FileExistsError:
+                if self._is_expired(takeover_file_path):
+                    try:
+                        os.remove(takeover_file_path)
+                    except OSError:
+                        pass
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.1)
+
+    def _unlock_takeover(self, relpath: str):
+        try:
+            os.remove(self._takeover_path(relpath))
+        except OSError:
+            pass
+
+    def _take_over(self, relpath: str, lease_file_path: str):
+        """
+        期限切れのleaseを消す
+        複数のマシンが同時に引き継ごうとしても、takeoverファイルを作成できた1台だけが確かめて消す
+        確かめる前に、ほかのマシンが引き継いで作り直したleaseや、持ち主が更新したleaseは消さない
+        """
+        observed = self._owner(lease_file_path)
+        if observed is None or not self._is_expired(lease_file_path):
+            return
+        # 取れなかった場合は、次の機会にやり直す
+        if not self._lock_takeover(relpath):
+            return
+        try:
+            if self._owner(lease_file_path) != observed or not self._is_expired(
+                lease_file_path
+            ):
+                logger.info(f"lease of {relpath} was renewed. back off")
+                return
+            os.remove(lease_file_path)
+            logger.warning(f"take over expired lease of {relpath} from {observed[0]}")
+        except OSError:
+            pass
+        finally:
+            self._unlock_takeover(relpath)
+
+    def claim(self, media_file_path: str) -> bool:
+        """
+        メディアファイルのleaseを取得できた場合はTrueを返す
+        処理済みのもの、ほかのマシン（自分を含む）が処理中のものはFalseを返す
+        """
+        relpath = self._relpath(media_file_path)
+        lease_file_path, _ = self._paths(relpath)
+        if self._is_done(relpath):
+            return False
+        if self._is_expired(lease_file_path):
+            self._take_over(relpath, lease_file_path)
+        try:
+            fd = os.open(lease_file_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w", encoding="UTF-8") as f:
+            json.dump(dict(node_id=self._node_id, media=relpath), f, ensure_ascii=False)
+        with self._lock:
+            self._held.add(relpath)
+            self._media_stats[relpath] = self._media_stat(relpath)
+        logger.info(f"lease of {relpath} acquired by {self._node_id}")
+        return True
+
+    def complete(self, media_file_path: str):
+        """
+        処理済みの印をつけて、leaseを手放す
+        leaseがほかのマシンに引き継がれていた場合は、そのマシンのleaseを消さない
+        """
+        relpath = self._relpath(media_file_path)
+        lease_file_path, done_file_path = self._paths(relpath)
+        with self._lock:
+            self._held.discard(relpath)
+            media_stat = self._media_stats.pop(relpath, None) or self._media_stat(relpath)
+        with open(done_file_path, "w", encoding="UTF-8") as f:
+            json.dump(
+                dict(
+                    node_id=self._node_id,
+                    media=relpath,
+                    done_at=time.time(),
+                    **(media_stat or {}),
+                ),
+                f,
+                ensure_ascii=False,
+            )
+        # 引き継ぎと重ならないように、takeoverを作成してから持ち主を確かめる
+        # 取れなかった場合は消さずに残す（doneがあるので、期限切れになっても引き継がれない）
+        if not self._lock_takeover(relpath, timeout=LEASE_HEARTBEAT_SECONDS):
+            logger.warning(f"failed to lock lease of {relpath}. leave it")
+            return
+        try:
+            lease = self._read(lease_file_path)
+            # 作成直後で中身がないleaseは、ほかのマシンが取ったばかりのもの
+            if lease is None or lease["node_id"] != self._node_id:
+                logger.warning(f"lease of {relpath} is held by another node. leave it")
+                return
+            os.remove(lease_file_path)
+        except FileNotFoundError:
+            pass
+        finally:
+            self._unlock_takeover(relpath)
+
+    def release(self, media_file_path: str):
+        """
+        処理済みにせずにleaseの更新をやめる（期限切れになったら、ほかのマシンがやり直す）
+        """
+        relpath = self._relpath(media_file_path)
+        with self._lock:
+            self._held.discard(relpath)
+            self._media_stats.pop(relpath, None)
+
+    def find_expired(self) -> List[str]:
+        """
+        期限切れで、まだ処理済みになっていないメディアファイルのパスを返す
+        """
+        media_file_paths = []
+        for file_name in os.listdir(self._lease_dir):
+            if not file_name.endswith(".lease"):
+                continue
+            lease_file_path = os.path.join(self._lease_dir, file_name)
+            if not self._is_expired(lease_file_path):
+                continue
+            lease = self._read(lease_file_path)
+            if lease is None:
+                continue
+            media_file_path = os.path.join(self._root_dir, *lease["media"].split("/"))
+            if self._is_done(lease["media"]) or not os.path.exists(media_file_path):
+                continue
+            media_file_paths.append(media_file_path)
+        return media_file_paths
+
+    def _heartbeat(self):
+        with self._lock:
+            held = list(self._held)
+        for relpath in held:
+            lease_file_path, _ = self._paths(relpath)
+            lease = self._read(lease_file_path)
+            # ほかのマシンに引き継がれていた場合は、手放す
+            if lease is not None and lease["node_id"] != self._node_id:
+                logger.warning(f"lease of {relpath} was taken over by {lease['node_id']}")
+                with self._lock:
+                    self._held.discard(relpath)
+                continue
+            try:
+                os.utime(lease_file_path)
+            except FileNotFoundError:
+                logger.warning(f"lease of {relpath} was lost")
+                with self._lock:
+                    self._held.discard(relpath)
+
+    def _run(self):
+        while not self._stop_event.wait(LEASE_HEARTBEAT_SECONDS):
+            try:
+                self._heartbeat()
+            except Exception as e:
+                logger.warning("failed to renew leases")
+                logger.warning(e)
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        # 処理中のleaseはそのまま残し、期限切れになったらほかのマシンに引き継いでもらう
+        self._stop_event.set()
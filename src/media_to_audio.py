@@ -23,14 +23,11 @@ def media_to_audio_task(task: Task) -> Task:
 
     if not task.media_file_path or not os.path.exists(str(task.media_file_path)):
         logger.warning(f"{task.id_} - {task.media_file_path} does not exist")
-        result = task.model_copy(
-            deep=True,
-            update=dict(
-                status="error",
-                progress="media file does not exist",
-                message="メディアファイルが見つかりません",
-                audio_file_path=None,
-            ),
+        result = task.evolve(
+            status="error",
+            progress="media file does not exist",
+            message="メディアファイルが見つかりません",
+            audio_file_path=None,
         )
         return result
 
@@ -45,29 +42,33 @@ def media_to_audio_task(task: Task) -> Task:
             audio_file_path=audio_file_path,
         )
         logger.info(f"{task.id_} - finish converting media to audio")
+    except TimeoutError as e:
+        logger.warning(f"{task.id_} - ffmpeg was killed because it took too long time")
+        logger.warning(f"{task.id_} - {e}")
+        result = task.evolve(
+            status="error",
+            progress="converting to audio timed out",
+            message="音声の抽出が制限時間内に終わりませんでした",
+            audio_file_path=None,
+        )
+        return result
     except Exception as e:
         logger.warning(
             f"{task.id_} - error occurred while converting to audio. error may occur when ffmpeg takes too long time"
         )
         logger.warning(f"{task.id_} - {e}")
-        result = task.model_copy(
-            deep=True,
-            update=dict(
-                status="error",
-                progress="error occurred while converting to audio",
-                message="音声を抽出する際にエラーが発生しました",
-                audio_file_path=None,
-            ),
+        result = task.evolve(
+            status="error",
+            progress="error occurred while converting to audio",
+            message="音声を抽出する際にエラーが発生しました",
+            audio_file_path=None,
         )
         return result
     # 処理結果情報
-    result = task.model_copy(
-        deep=True,
-        update=dict(
-            status="success",
-            progress="audio file created",
-            audio_file_path=audio_file_path,
-        ),
+    result = task.evolve(
+        status="success",
+        progress="audio file created",
+        audio_file_path=audio_file_path,
     )
     logger.info(f"{task.id_} - media_to_audio_task finished")
     return result
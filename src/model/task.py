@@ -1,7 +1,13 @@
 from typing import List, Literal, Union
 
 from pydantic import BaseModel
-from src.functions.model import AudioData, Transcription
+from src.functions.model import (
+    AudioData,
+    CompactionStats,
+    MediaProbe,
+    SectionSummary,
+    Transcription,
+)
 from src.model import Response, Summarization
 
 
@@ -13,8 +19,29 @@ class Task(BaseModel):
     media_file_path: Union[str, None] = None
     audio_file_path: Union[str, None] = None
     media_file_name: Union[str, None] = None
+    media_probe: Union[MediaProbe, None] = None
     audio_data_list: Union[List[AudioData], None] = None
     transcriptions: Union[List[Transcription], None] = None
+    # transcriptionsをファイルに保存した場合のパス（artifact_store参照）
+    transcriptions_file_path: Union[str, None] = None
+    section_summaries: Union[List[SectionSummary], None] = None
+    compaction_stats: Union[CompactionStats, None] = None
     summarization: Union[Summarization, None] = None
     response: Union[Response, None] = None
     message: Union[str, None] = None
+    # ワーカーの異常終了により、処理をやり直した回数
+    restart_count: int = 0
+
+    def evolve(self, **update) -> "Task":
+        """
+        一部のフィールドだけを変更した新しいTaskを返す
+        変更しないフィールド（audio_data_list, transcriptionsなど）はコピーせず共有する
+        各処理はTaskの中身を書き換えずに、新しい値をupdateで渡すこと
+        """
+        return self.model_copy(update=update)
+
+    def to_log_dict(self) -> dict:
+        """
+        ログ出力用に、大きなフィールドを除いたdictを返す
+        """
+        return self.model_dump(exclude={"audio_data_list", "transcriptions"})
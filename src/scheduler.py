@@ -0,0 +1,90 @@
+import math
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from src.config import (
+    SCHEDULER_AGING_RATE,
+    SCHEDULER_FAIRNESS_HALF_LIFE_SECONDS,
+    SCHEDULER_MAX_WAIT_SECONDS,
+)
+from src.functions import MediaToAudioConverter
+from src.log.my_logger import MyLogger
+from src.model import Task
+
+my_logger = MyLogger(__name__)
+logger = my_logger.logger
+
+
+class FairScheduler:
+    """
+    キューに入れる前のタスクを預かり、次に処理するタスクを選ぶ
+
+    - 回答者（Response.responder）ごとに、これまでに処理した長さ（時間とともに減衰）が最も少ない人を選ぶ
+    - その人のタスクの中から、メディアの長さが最も短いものを選ぶ（待った時間だけ短いとみなす）
+    - SCHEDULER_MAX_WAIT_SECONDSより長く待ったタスクは、最も長く待ったものから優先する
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (追加した時刻, メディアの長さ, タスク)
+        self._pending: List[Tuple[float, float, Task]] = []
+        # 回答者ごとの処理した長さと、最後に更新した時刻
+        self._served: Dict[str, Tuple[float, float]] = {}
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    @staticmethod
+    def _responder(task: Task) -> str:
+        return task.response.responder if task.response else ""
+
+    @staticmethod
+    def _duration(task: Task) -> float:
+        if task.media_probe is not None:
+            return task.media_probe.duration
+        if task.status == "error" or not task.media_file_path:
+            return 0.0
+        try:
+            return MediaToAudioConverter.probe(task.media_file_path).duration
+        except Exception as e:
+            logger.warning(f"{task.id_} - failed to probe {task.media_file_path}")
+            logger.warning(f"{task.id_} - {e}")
+            return 0.0
+
+    def _served_seconds(self, responder: str, now: float) -> float:
+        served, updated_at = self._served.get(responder, (0.0, now))
+        return served * math.pow(0.5, (now - updated_at) / SCHEDULER_FAIRNESS_HALF_LIFE_SECONDS)
+
+    def has_media(self, media_file_path: str) -> bool:
+        with self._lock:
+            return any([p[2].media_file_path == media_file_path for p in self._pending])
+
+    def push(self, task: Task):
+        duration = self._duration(task)
+        with self._lock:
+            self._pending.append((time.time(), duration, task))
+
+    def pop(self) -> Task:
+        with self._lock:
+            now = time.time()
+            starved = [p for p in self._pending if now - p[0] >= SCHEDULER_MAX_WAIT_SECONDS]
+            if starved:
+                selected = min(starved, key=lambda p: p[0])
+            else:
+                # 処理した長さが同じ回答者どうしでは、短いタスクを持つ人を先にする
+                selected = min(
+                    self._pending,
+                    key=lambda p: (
+                        self._served_seconds(self._responder(p[2]), now),
+                        p[1] - SCHEDULER_AGING_RATE * (now - p[0]),
+                    ),
+                )
+            self._pending.remove(selected)
+            responder = self._responder(selected[2])
+            self._served[responder] = (
+                self._served_seconds(responder, now) + selected[1],
+                now,
+            )
+            return selected[2]
@@ -30,36 +30,27 @@ def split_audio_task(task: Task) -> Task:
     except Exception as e:
         logger.error(f"{task.id_} - error occurred while splitting audio file")
         logger.error(f"{task.id_} - {e}")
-        result = task.model_copy(
-            deep=True,
-            update=dict(
-                status="error",
-                progress="error occurred while splitting audio file",
-                message="音声ファイルの加工に失敗しました",
-                audio_data_list=None,
-            ),
+        result = task.evolve(
+            status="error",
+            progress="error occurred while splitting audio file",
+            message="音声ファイルの加工に失敗しました",
+            audio_data_list=None,
         )
         return result
     if len(audio_data_list) == 0:
         logger.warning(f"{task.id_} - failed to split audio file")
-        result = task.model_copy(
-            deep=True,
-            update=dict(
-                status="error",
-                progress="audio file is not splitted",
-                message="音声ファイルを加工しましたが，ファイルが見つかりません",
-                audio_data_list=None,
-            ),
+        result = task.evolve(
+            status="error",
+            progress="audio file is not splitted",
+            message="音声ファイルを加工しましたが，ファイルが見つかりません",
+            audio_data_list=None,
         )
         return result
     # 処理結果情報
-    result = task.model_copy(
-        deep=True,
-        update=dict(
-            status="success",
-            progress="audio file splitted",
-            audio_data_list=audio_data_list,
-        ),
+    result = task.evolve(
+        status="success",
+        progress="audio file splitted",
+        audio_data_list=audio_data_list,
     )
     logger.info(f"{task.id_} - audio is splitted in {len(audio_data_list)} pieces")
     logger.info(f"{task.id_} - split_audio_task finished")
@@ -1,4 +1,7 @@
+from src.artifact_store import load_transcriptions
 from src.functions import summarize_transcription
+from src.functions.config import USE_TRANSCRIPT_COMPACTION
+from src.functions.utils import compact_transcriptions, measure_compaction
 from src.log.my_logger import MyLogger
 from src.model import Summarization, Task
 
@@ -17,14 +20,38 @@ def summarization_task(task: Task) -> Task:
     """
     logger.info(f"{task.id_} - summarization_task called")
 
-    if not task.transcriptions or not task.response:
+    if not task.response:
         return task
+    try:
+        transcriptions = load_transcriptions(task)
+    except Exception as e:
+        logger.error(f"{task.id_} - error occurred while loading transcriptions")
+        logger.error(f"{task.id_} - {e}")
+        result = task.evolve(
+            status="error",
+            progress="error occurred while loading transcriptions",
+            message="文字起こし結果の読み込みに失敗しました",
+            summarization=None,
+        )
+        return result
+    if not transcriptions:
+        return task
+    compaction_stats = task.compaction_stats
+    if USE_TRANSCRIPT_COMPACTION:
+        # 要約の前に、つなぎ言葉や繰り返しを取り除いてトークンを減らす
+        compacted_transcriptions = compact_transcriptions(transcriptions)
+        # transcription_taskで要約と並行して取り除いた場合は、そのときの削減量を使う
+        if compaction_stats is None:
+            compaction_stats = measure_compaction(transcriptions, compacted_transcriptions)
+            logger.info(f"{task.id_} - transcriptions compacted: {compaction_stats}")
+        transcriptions = compacted_transcriptions
     try:
         logger.info(f"{task.id_} - summarizing text")
         summary = summarize_transcription(
-            transcriptions=task.transcriptions,
+            transcriptions=transcriptions,
             add_title=task.response.add_title,
             add_todo=task.response.add_todo,
+            section_summaries=task.section_summaries,
         )
         # logger.info("compressing text")
         # compressed_text = compress_text(task.transcriptions)
@@ -39,24 +66,19 @@ def summarization_task(task: Task) -> Task:
     except Exception as e:
         logger.error(f"{task.id_} - error occurred while summarizing text")
         logger.error(f"{task.id_} - {e}")
-        result = task.model_copy(
-            deep=True,
-            update=dict(
-                status="error",
-                progress="error occurred while summarizing text",
-                message="要約中にエラーが発生しました",
-                summarization=None,
-            ),
+        result = task.evolve(
+            status="error",
+            progress="error occurred while summarizing text",
+            message="要約中にエラーが発生しました",
+            summarization=None,
         )
         return result
-    result = task.model_copy(
-        deep=True,
-        update=dict(
-            status="success",
-            progress="summarization completed",
-            message="要約が完了しました",
-            summarization=summarization,
-        ),
+    result = task.evolve(
+        status="success",
+        progress="summarization completed",
+        message="要約が完了しました",
+        summarization=summarization,
+        compaction_stats=compaction_stats,
     )
     logger.info(f"{task.id_} - summarization_task finished")
     return result
@@ -1,15 +1,42 @@
 import time
-from typing import List
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Union
 
-from src.functions import extract_keywords, recognite_speakers, transcript_audio
-from src.functions.model import Transcription
+from src.functions import (
+    extract_keywords,
+    recognite_speakers_in_section,
+    summarize_section,
+    transcript_audio,
+)
+from src.functions.config import (
+    INCREMENTAL_SUMMARIZATION,
+    INCREMENTAL_SUMMARIZATION_MAX_WORKERS,
+    USE_SPEAKER_RECOGNITION,
+    USE_TRANSCRIPT_COMPACTION,
+)
+from src.functions.model import SectionSummary, Transcription
+from src.functions.utils import (
+    OnlineSpeakerClusterer,
+    SpeakerIndex,
+    TranscriptTable,
+    compact_transcriptions,
+    measure_compaction,
+)
+from src.artifact_store import save_transcriptions
 from src.log.my_logger import MyLogger
 from src.model import Task
+from src.utils import parse_speakers
 
 my_logger = MyLogger(__name__)
 logger = my_logger.logger
 
 
+# transcriptionsのstart, endを更新するときの丸め
+def my_round(number, ndigits=0):
+    p = 10**ndigits
+    return (number * p * 2 + 1) // 2 / p
+
+
 def transcription_task(task: Task) -> Task:
     """
     文字起こし処理を行う関数
@@ -24,6 +51,22 @@ def transcription_task(task: Task) -> Task:
     transcriptions: List[Transcription] = []
     if not task.audio_data_list:
         return task
+    # 文字起こしが終わったsectionから順に、別スレッドで修正と要約を始める
+    executor: Union[ThreadPoolExecutor, None] = None
+    if INCREMENTAL_SUMMARIZATION and task.response:
+        executor = ThreadPoolExecutor(max_workers=INCREMENTAL_SUMMARIZATION_MAX_WORKERS)
+    futures: List[Future] = []
+    # 要約のためにつなぎ言葉や繰り返しを取り除いた文字起こし（削減量の記録用）
+    compacted_transcriptions: List[Transcription] = []
+    # 話者識別は、sectionごとに話者の重心を更新しながら行う
+    clusterer: Union[OnlineSpeakerClusterer, None] = None
+    speaker_index: Union[SpeakerIndex, None] = None
+    if USE_SPEAKER_RECOGNITION and task.response:
+        speakers = parse_speakers(task.response.speakers)
+        if speakers is not None:
+            # 話者数の候補の場合は、最初のsectionでx-meansを使って話者数を推定する
+            clusterer = OnlineSpeakerClusterer(n_speakers=speakers)
+            speaker_index = SpeakerIndex()
     for i, audio_data in enumerate(task.audio_data_list):
         logger.info(
             f"{task.id_} - section={i+1}/{len(task.audio_data_list)}, start={audio_data.start}, end={audio_data.end}"
@@ -42,9 +85,36 @@ def transcription_task(task: Task) -> Task:
         try:
             desc = ", ".join(list(prompt_dict.values()))
             logger.info(f"{task.id_} - transcribing audio file")
-            transcriptions += transcript_audio(
+            section_transcriptions = transcript_audio(
                 audio_data=audio_data, description=desc, section=i
             )
+            if clusterer is not None:
+                logger.info(f"{task.id_} - recogniting speakers")
+                section_transcriptions = recognite_speakers_in_section(
+                    audio_data, section_transcriptions, clusterer, speaker_index
+                )
+            # transcriptionsのstart, endを更新
+            # audio_dataのstartは小数点第1位で丸める
+            start = my_round(audio_data.start, 1)
+            section_transcriptions = (
+                TranscriptTable.from_transcriptions(section_transcriptions)
+                .rebase(start)
+                .to_transcriptions()
+            )
+            transcriptions += section_transcriptions
+            # summarization_taskと同じく、つなぎ言葉や繰り返しを取り除いてから要約する
+            if executor is not None and USE_TRANSCRIPT_COMPACTION:
+                section_transcriptions = compact_transcriptions(section_transcriptions)
+                compacted_transcriptions += section_transcriptions
+            if executor is not None and section_transcriptions:
+                logger.info(f"{task.id_} - start summarizing section={i+1}")
+                futures.append(
+                    executor.submit(
+                        summarize_section,
+                        section_transcriptions,
+                        len(task.audio_data_list) == 1,
+                    )
+                )
             time.sleep(30)
             # ここで、文字起こしの修正をしようとしたが、うまくいかなかったのでコメントアウト
             # logger.info(f"{task.id_} - correcting transcriptions")
@@ -64,50 +134,47 @@ def transcription_task(task: Task) -> Task:
             logger.error(f"{task.id_} - error occurred while transcribing audio file")
             logger.error(f"{task.id_} - audio_data = {audio_data}")
             logger.error(f"{task.id_} - {e}")
-            result = task.model_copy(
-                deep=True,
-                update=dict(
-                    status="error",
-                    progress="error occurred while transcribing audio file",
-                    message="文字起こし中にエラーが発生しました",
-                    transcriptions=None,
-                ),
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+            result = task.evolve(
+                status="error",
+                progress="error occurred while transcribing audio file",
+                message="文字起こし中にエラーが発生しました",
+                transcriptions=None,
             )
             return result
 
-    # TODO:話者識別
-    # 将来話者識別できるように、発言者数を収集しているが、
-    # 現時点ではうまくいかないのでコメントアウト
-    # if task.response.recognite_speakers:
-    #     logger.info(f"{task.id_} - recogniting speakers")
-    #     transcriptions = recognite_speakers(
-    #         task.audio_data_list,
-    #         transcriptions,
-    #         task.response.speakers,
-    #     )
-
-    # transcriptionsのstart, endを更新
-    # 基準になる秒数を計算
-    def my_round(number, ndigits=0):
-        p = 10**ndigits
-        return (number * p * 2 + 1) // 2 / p
-
-    logger.info(f"{task.id_} - updating start/end of transcriptions")
-    new_transcriptions = []
-    for t in transcriptions:
-        audio_data = task.audio_data_list[t.section]
-        # audio_dataのstartは小数点第1位で丸める
-        start = my_round(audio_data.start, 1)
-        update_ = dict(start=t.start + start, end=t.end + start)
-        new_transcriptions += [t.model_copy(update=update_)]
+    # 並行して進めていたsectionごとの要約を回収する
+    # 失敗したsectionは、summarization_taskで要約し直す
+    section_summaries: List[SectionSummary] = []
+    for future in futures:
+        try:
+            section_summaries.append(future.result())
+        except Exception as e:
+            logger.warning(f"{task.id_} - failed to summarize section")
+            logger.warning(f"{task.id_} - {e}")
+    if executor is not None:
+        executor.shutdown()
+    # 削減量はここで記録して、summarization_taskでは数え直さない
+    compaction_stats = None
+    if executor is not None and USE_TRANSCRIPT_COMPACTION:
+        compaction_stats = measure_compaction(transcriptions, compacted_transcriptions)
+        logger.info(f"{task.id_} - transcriptions compacted: {compaction_stats}")
 
-    result = task.model_copy(
-        deep=True,
-        update=dict(
-            status="success",
-            progress="transcription completed",
-            transcriptions=new_transcriptions,
-        ),
+    # 文字起こし結果は大きいので、ファイルに保存してパスだけを次の処理に渡す
+    transcriptions_file_path: Union[str, None] = None
+    try:
+        transcriptions_file_path = save_transcriptions(task.id_, transcriptions)
+    except Exception as e:
+        logger.warning(f"{task.id_} - failed to save transcriptions to file")
+        logger.warning(f"{task.id_} - {e}")
+    result = task.evolve(
+        status="success",
+        progress="transcription completed",
+        transcriptions=None if transcriptions_file_path else transcriptions,
+        transcriptions_file_path=transcriptions_file_path,
+        section_summaries=section_summaries or None,
+        compaction_stats=compaction_stats,
     )
     logger.info(f"{task.id_} - transcription_task finished")
     return result
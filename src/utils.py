@@ -1,11 +1,12 @@
+import gzip
 import json
 import os
 import re
-from datetime import datetime as dt
 from glob import glob
-from typing import Union
+from typing import List, Union
 
-from src.config import RESPONSE_KEY
+from src.artifact_store import load_transcriptions, remove_artifacts
+from src.config import RESPONSE_KEY, SAVE_TRANSCRIPTIONS_SEPARATELY
 from src.log.my_logger import MyLogger
 from src.model import MediaInfo, Response, Task
 
@@ -100,6 +101,28 @@ def read_response_file(response_file_path: Union[str, None]) -> Union[Response,
     return response
 
 
+def parse_speakers(speakers: Union[str, None]) -> Union[int, List[int], None]:
+    """
+    回答の話者数を、話者識別で使う形に変換する関数
+
+    Args:
+        speakers (str): 回答の話者数（"話者判別しない", "3人", "2人~5人"など）
+
+    Returns:
+        int | list[int] | None: 話者数，話者数の候補，話者識別しない場合はNone
+    """
+    if speakers == "話者判別しない":
+        return None
+    # 正規表現で"*人"にマッチするやつは、*をintにする
+    if speakers and re.fullmatch(r"\d+人", speakers):
+        return int(speakers.replace("人", ""))
+    if speakers == "2人~5人":
+        return list(range(2, 6))
+    if speakers == "5人~10人":
+        return list(range(5, 11))
+    return list(range(2, 11))
+
+
 def clean_up(result: Task):
     """
     処理結果情報をクリーンアップする関数
@@ -128,10 +151,29 @@ def clean_up(result: Task):
             except Exception as e:
                 logger.warning(f"{result.id_} - failed to remove audio file")
                 logger.warning(f"{result.id_} - {e}")
+    if result.transcriptions_file_path:
+        remove_artifacts(result.id_)
+        logger.info(f"{result.id_} - remove artifacts")
     logger.info(f"{result.id_} - finish cleaning up")
     return
 
 
+def _write_atomically(file_path: str, data: bytes):
+    # 書き込み途中のファイルを読まれないように、同じディレクトリの一時ファイルに書いてから置き換える
+    tmp_file_path = os.path.join(
+        os.path.dirname(file_path), f".{os.path.basename(file_path)}.{os.getpid()}.tmp"
+    )
+    try:
+        with open(tmp_file_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file_path, file_path)
+    finally:
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
+
+
 def save_result(result: Task):
     """
     処理結果情報を保存する関数
@@ -144,25 +186,48 @@ def save_result(result: Task):
     """
     logger.info(f"{result.id_} - save_result called")
     # 処理結果情報を保存する
-    root_dir = os.path.dirname(os.path.dirname(result.response_file_path))
-    result_dir = os.path.join(root_dir, "result")
-
     if not result.response_file_path:
         logger.warning(f"{result.id_} - response file path is not found")
         logger.info(f"{result.id_} - finish saving result")
-        time_str = dt.now().strftime("%Y%m%d%H%M%S")
-        result_file_path = os.path.join(result_dir, f"error_{time_str}.json")
-        # result_file_path = os.path.join(result_dir, f"error_clone.json")
         return
 
+    root_dir = os.path.dirname(os.path.dirname(result.response_file_path))
+    result_dir = os.path.join(root_dir, "result")
     response_file_name = os.path.basename(result.response_file_path)
     result_file_path = os.path.join(result_dir, response_file_name)
     # result_file_path = os.path.join(result_dir, "clone.json")
 
     if not os.path.exists(result_dir):
         os.makedirs(result_dir, exist_ok=True)
-    with open(result_file_path, "w", encoding="UTF-8") as f:
-        json.dump(result.model_dump(), f, ensure_ascii=False, indent=4)
+    # ファイルに保存されている文字起こし結果は、ここで読み込んで結果に含める
+    try:
+        result = result.evolve(transcriptions=load_transcriptions(result))
+    except Exception as e:
+        logger.warning(f"{result.id_} - failed to load transcriptions")
+        logger.warning(f"{result.id_} - {e}")
+    if SAVE_TRANSCRIPTIONS_SEPARATELY and result.transcriptions:
+        # 文字起こし結果は別のファイルに圧縮して保存し、結果ファイルにはファイル名だけを書く
+        # 結果ファイルが先に読まれても困らないように、こちらを先に保存する
+        transcriptions_file_name = os.path.splitext(response_file_name)[0]
+        transcriptions_file_name += ".transcriptions.json.gz"
+        transcriptions_json = "[{}]".format(
+            ",".join([t.model_dump_json() for t in result.transcriptions])
+        )
+        _write_atomically(
+            os.path.join(result_dir, transcriptions_file_name),
+            gzip.compress(transcriptions_json.encode("UTF-8")),
+        )
+        logger.info(f"{result.id_} - transcriptions saved to {transcriptions_file_name}")
+        summarization = result.summarization
+        if summarization is not None:
+            summarization = summarization.model_copy(
+                update=dict(Transcription_file_url=transcriptions_file_name)
+            )
+        result = result.evolve(transcriptions=None, summarization=summarization)
+    _write_atomically(
+        result_file_path,
+        result.model_dump_json(exclude={"transcriptions_file_path"}).encode("UTF-8"),
+    )
     logger.info(f"{result.id_} - result saved to {result_file_path}")
     logger.info(f"{result.id_} - finish saving result")
     return